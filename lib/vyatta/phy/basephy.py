@@ -5,6 +5,8 @@
 # **** End License ****
 
 from abc import ABC, abstractmethod
+from time import sleep
+import socket
 
 class PhyException(Exception):
     pass
@@ -17,7 +19,188 @@ class PhyAccessException(PhyException):
     def __init__(self, arg):
         self.arg = arg
 
+class PhyTransaction(object):
+    """
+    A set of PHY register changes that are committed together with a
+    single soft reset.
+
+    Changes to the same register are merged, so that each register
+    is modified at most once when the transaction is committed.
+    """
+    def __init__(self, phy, bus):
+        self.phy = phy
+        self.bus = bus
+        # Register to (mask, value), in the order first modified
+        self.changes = {}
+
+    def modify(self, reg, mask, value):
+        """
+        Stage a modification of a register, masking off bits and
+        or'ing in a new value, in host endian form.
+        """
+        (staged_mask, staged_value) = self.changes.get(reg, (0, 0))
+        self.changes[reg] = (staged_mask | mask,
+                             (staged_value & ~mask) | value)
+
+    def commit(self, wait=True):
+        """
+        Write the staged changes and perform a soft reset to commit
+        them. If wait is False then don't wait for the reset to
+        complete, see BasePhy.reset_complete.
+        """
+        self.phy.commit_transaction(self, wait=wait)
+        self.changes = {}
+
 class BasePhy(ABC):
+    # Capabilities advertised by default when enabling auto-negotiate
+    ALL_AUTONEG_CAPS = {
+        '1000full': True,
+        '1000half': True,
+        '100full': True,
+        '100half': True,
+        '10full': True,
+        '10half': True,
+    }
+
+    # Finisar Application Note AN-2036 and by convention
+    PHYADDR = 0x56
+
+    # From IEEE 802.3 clause 22: the control register and its
+    # software reset bit
+    REG_CTRL = 0x00
+    CTRL_RESET = 0x8000
+
+    # Configuration registers that are only changed by us, so whose
+    # values can be remembered in a shadow rather than read back from
+    # the PHY before modifying them
+    SHADOWED_REGS = frozenset()
+
+    # Register operations that can be passed to bus_batch
+    OP_READ = 'read'
+    OP_WRITE = 'write'
+    OP_MODIFY = 'modify'
+
+    def __init__(self):
+        self._shadow = {}
+        self.link_interrupts_enabled = False
+
+    def invalidate_shadow(self):
+        """
+        Forget the shadowed register values, for example because the
+        state of the PHY is no longer known.
+        """
+        self._shadow = {}
+
+    @staticmethod
+    def bus_batch(bus, ops):
+        """
+        Perform a list of register operations on the bus.
+
+        Each operation is a tuple of one of:
+         - (OP_READ, addr, reg)
+         - (OP_WRITE, addr, reg, data)
+         - (OP_MODIFY, addr, reg, mask, value)
+        with data, mask and value in the byte order used by the
+        bus. A modify clears the bits in mask and then ors in value.
+
+        Returns a list with an entry per operation, which is the value
+        read for a read, the value written for a modify and None for
+        a write.
+
+        Buses that can perform a list of operations in one go do so
+        via their batch_word_data method, otherwise the operations are
+        performed one at a time.
+        """
+        batch_word_data = getattr(bus, 'batch_word_data', None)
+        if batch_word_data is not None:
+            return batch_word_data(ops)
+        return BasePhy.bus_ops_singly(bus, ops)
+
+    @staticmethod
+    def bus_ops_singly(bus, ops):
+        """
+        Perform a list of register operations on the bus one at a time
+        using read_word_data and write_word_data
+        """
+        results = []
+        for op in ops:
+            if op[0] == BasePhy.OP_READ:
+                (_, addr, reg) = op
+                results.append(bus.read_word_data(addr, reg))
+            elif op[0] == BasePhy.OP_WRITE:
+                (_, addr, reg, data) = op
+                bus.write_word_data(addr, reg, data)
+                results.append(None)
+            elif op[0] == BasePhy.OP_MODIFY:
+                (_, addr, reg, mask, value) = op
+                data = (bus.read_word_data(addr, reg) & ~mask) | value
+                bus.write_word_data(addr, reg, data)
+                results.append(data)
+            else:
+                raise PhyAccessException("unknown operation %s" % op[0])
+        return results
+
+    def _phy_modify_reg(self, bus, reg, mask, value):
+        """
+        Modify a PHY register, masking off bits and or'ing in a new value
+
+        Mask and value should be in host endian form.
+        """
+        self._phy_modify_regs(bus, [(reg, mask, value)])
+
+    def _phy_modify_regs(self, bus, modifications):
+        """
+        Modify a list of PHY registers in one batch
+
+        Each modification is a tuple of (reg, mask, value), with mask
+        and value in host endian form.
+        """
+        ops = []
+        for (reg, mask, value) in modifications:
+            if reg in self._shadow:
+                # No need to read back a register we know the value of
+                new_value = (self._shadow[reg] & ~mask) | value
+                ops.append((self.OP_WRITE, self.PHYADDR, reg,
+                            socket.htons(new_value)))
+            else:
+                # Masking and or'ing commute with swapping bytes, so
+                # the modification can be done in bus byte order
+                ops.append((self.OP_MODIFY, self.PHYADDR, reg,
+                            socket.htons(mask), socket.htons(value)))
+
+        try:
+            results = BasePhy.bus_batch(bus, ops)
+        except Exception:
+            self.invalidate_shadow()
+            raise
+
+        for (reg, _, _), op, result in zip(modifications, ops, results):
+            if reg not in self.SHADOWED_REGS:
+                continue
+            if op[0] == self.OP_WRITE:
+                written = socket.ntohs(op[3])
+            else:
+                written = socket.ntohs(result)
+            if reg == self.REG_CTRL:
+                # The reset bit clears itself
+                written &= ~self.CTRL_RESET
+            self._shadow[reg] = written
+
+    def _phy_wait_soft_reset(self, bus):
+        """
+        Wait for a software reset to complete
+        """
+        # From 802.3 22.2.4.1.1: The reset process shall be completed
+        # within 0.5 s from the setting of bit 0.15
+        # So we shoot a bit over to 0.525s
+        for i in range(0, 600, 75):
+            if self.reset_complete(bus):
+                return
+            # 75ms
+            sleep(0.075)
+        self.invalidate_shadow()
+        raise PhyAccessException("reset timed out")
+
     @abstractmethod
     def is_sgmii_capable(self, bus):
         """
@@ -27,18 +210,26 @@ class BasePhy(ABC):
         pass
 
     @abstractmethod
-    def enable_sgmii(self, bus):
+    def enable_sgmii(self, bus, wait=True):
         """
         Enable SGMII mode on the PHY. If the PHY uses SGMII by default
         then this can be a no-op.
+
+        If wait is False then return as soon as the change has been
+        issued, as for set_autoneg_caps.
         """
         pass
 
     @abstractmethod
-    def set_autoneg_caps(self, bus, caps):
+    def set_autoneg_caps(self, bus, caps, wait=True):
         """
         Set auto-negotiate enabled and its capabilities.
 
+        If wait is False then return as soon as the change has been
+        issued, without waiting for any reset needed to commit it to
+        complete. reset_complete can then be used to find out when
+        it has.
+
         Caps is a map of key to boolean value that describes the set
         of capabilities to advertise. Capabilities supported are:
          - 1000full
@@ -82,8 +273,65 @@ class BasePhy(ABC):
         pass
 
     @abstractmethod
-    def set_speed_duplex(self, bus, speed, duplex):
+    def set_speed_duplex(self, bus, speed, duplex, wait=True):
         """
         Disable autonegotiate and use the specified speed and duplex.
+
+        If wait is False then return as soon as the change has been
+        issued, as for set_autoneg_caps.
         """
         pass
+
+    def transaction(self, bus):
+        """
+        Start a transaction for staging register changes to be
+        committed with a single soft reset.
+        """
+        return PhyTransaction(self, bus)
+
+    def commit_transaction(self, txn, wait=True):
+        """
+        Write the changes staged in the transaction and perform a soft
+        reset to commit them.
+
+        The changes are written in one batch, with the reset merged
+        into the change to the control register, which is made last so
+        that the reset commits all of the other changes.
+        """
+        (ctrl_mask, ctrl_value) = txn.changes.get(self.REG_CTRL, (0, 0))
+        modifications = [(reg, mask, value)
+                         for reg, (mask, value) in txn.changes.items()
+                         if reg != self.REG_CTRL]
+        modifications.append((self.REG_CTRL, ctrl_mask,
+                              ctrl_value | self.CTRL_RESET))
+        self._phy_modify_regs(txn.bus, modifications)
+        # Don't rely on the interrupt enables surviving the reset
+        self.link_interrupts_enabled = False
+        if wait:
+            self._phy_wait_soft_reset(txn.bus)
+
+    def reset_complete(self, bus):
+        """
+        Has the reset committing a change made with wait=False
+        completed?
+        """
+        return not (socket.ntohs(bus.read_word_data(self.PHYADDR, self.REG_CTRL)) & self.CTRL_RESET)
+
+    def enable_link_interrupts(self, bus):
+        """
+        Enable the latching of link, speed and duplex changes, so that
+        link_changed can tell whether the link status needs to be read.
+
+        Returns whether this is supported by the PHY.
+        """
+        return False
+
+    def link_changed(self, bus):
+        """
+        Has the link, speed or duplex changed since link_changed was
+        last called?
+
+        Reading the changes clears them. PHYs that can't tell, or
+        that haven't had link interrupts enabled, always return True.
+        """
+        return True
@@ -23,8 +23,17 @@ class Marvell88E1111Phy(BasePhy):
     REG_AUTONEG_ADV = 0x04
     REG_LPABIL = 0x05
     REG_PHY_STS = 0x11
+    REG_INT_ENABLE = 0x12
+    REG_INT_STATUS = 0x13
     REG_EX_PHY_STATUS = 0x1b
 
+    SHADOWED_REGS = frozenset([
+        REG_CTRL,
+        REG_AUTONEG_ADV,
+        REG_1000BASET_CTRL,
+        REG_EX_PHY_STATUS,
+    ])
+
     HWCFG_MODE_MASK = 0xf
     # SGMII without Clock with SGMII Auto-Neg to copper
     HWCFG_MODE_SGMII_NO_CLOCK = 0x4
@@ -52,46 +61,29 @@ class Marvell88E1111Phy(BasePhy):
     STS_1000FD = 1 << 11
     STS_1000HD = 1 << 10
 
+    # Speed, duplex and link status changed interrupts
+    INT_SPEED_CHANGED = 1 << 14
+    INT_DUPLEX_CHANGED = 1 << 13
+    INT_LINK_CHANGED = 1 << 10
+    INT_LINK_CHANGE_MASK = (INT_SPEED_CHANGED | INT_DUPLEX_CHANGED |
+                            INT_LINK_CHANGED)
+
     def is_sgmii_capable(self, bus):
         return True
 
-    def _phy_modify_reg(self, bus, reg, mask, value):
+    def stage_sgmii(self, txn):
         '''
-        Modify a PHY register, masking off bits and or'ing in a new value
-
-        Mask and value should be in host endian form.
+        Stage the hardware config mode and fiber/copper auto-selection
+        changes for SGMII
         '''
-        exist_value = socket.ntohs(bus.read_word_data(self.PHYADDR, reg))
-        new_value = (exist_value & ~mask) | value
-        bus.write_word_data(self.PHYADDR, reg, socket.htons(new_value))
+        txn.modify(self.REG_EX_PHY_STATUS,
+                   self.HWCFG_MODE_MASK | self.FIBER_COPPER_AS_MASK,
+                   self.HWCFG_MODE_SGMII_NO_CLOCK | self.FIBER_COPPER_AS_DISABLE)
 
-    def _phy_soft_reset(self, bus):
+    def stage_autoneg_caps(self, txn, speeds):
         '''
-        Perform a software reset and wait for it to complete
+        Stage the auto-neg enablement and advertisement changes
         '''
-        self._phy_modify_reg(bus, self.REG_CTRL, 0, self.CTRL_RESET)
-
-        # From 802.3 22.2.4.1.1: The reset process shall be completed
-        # within 0.5 s from the setting of bit 0.15
-        # So we shoot a bit over to 0.525s
-        for i in range(0, 600, 75):
-            if not (socket.ntohs(bus.read_word_data(self.PHYADDR, self.REG_CTRL)) & self.CTRL_RESET):
-                return
-            # 75ms
-            sleep(0.075)
-        raise PhyAccessException("reset timed out")
-
-    def enable_sgmii(self, bus):
-        self._phy_modify_reg(bus, self.REG_EX_PHY_STATUS,
-                             self.HWCFG_MODE_MASK | self.FIBER_COPPER_AS_MASK,
-                             self.HWCFG_MODE_SGMII_NO_CLOCK | self.FIBER_COPPER_AS_DISABLE)
-        # Commit the hardware config mode and fiber/copper
-        # auto-selection changes by performing a soft reset
-        self._phy_soft_reset(bus)
-
-        self.set_autoneg_caps(bus, {'1000full': True, '1000half': True, '100full': True, '100half': True, '10full': True, '10half': True })
-
-    def set_autoneg_caps(self, bus, speeds):
         an_adv = self.ADV_PAUSE | self.ADV_ASYM_PAUSE
         if speeds.get('100full', False):
             an_adv |= self.ADV_100FD
@@ -108,23 +100,52 @@ class Marvell88E1111Phy(BasePhy):
         if speeds.get('1000half', False):
             gbaset |= self.CTRL_1000BASE_T_HD
 
-        self._phy_modify_reg(bus, self.REG_AUTONEG_ADV,
-                             self.ADV_PAUSE | self.ADV_ASYM_PAUSE |
-                             self.ADV_100FD | self.ADV_100HD | self.ADV_10FD |
-                             self.ADV_10HD,
-                             an_adv)
-        self._phy_modify_reg(bus, self.REG_1000BASET_CTRL,
-                             self.CTRL_1000BASE_T_FD | self.CTRL_1000BASE_T_HD,
-                             gbaset)
+        txn.modify(self.REG_AUTONEG_ADV,
+                   self.ADV_PAUSE | self.ADV_ASYM_PAUSE |
+                   self.ADV_100FD | self.ADV_100HD | self.ADV_10FD |
+                   self.ADV_10HD,
+                   an_adv)
+        txn.modify(self.REG_1000BASET_CTRL,
+                   self.CTRL_1000BASE_T_FD | self.CTRL_1000BASE_T_HD,
+                   gbaset)
+        txn.modify(self.REG_CTRL, 0, self.CTRL_AN_ENABLE)
+
+    def stage_speed_duplex(self, txn, speed, duplex):
+        '''
+        Stage the auto-neg disable and forced speed changes
+        '''
+        speed_to_regval = {
+            1000: 0x0040,
+            100: 0x2000,
+            10: 0x0000,
+        }
+        ctrl_reg_val = speed_to_regval[speed]
+        if duplex == 'half':
+            # bit 8 = 0
+            pass
+        else:
+            ctrl_reg_val |= 0x0100
+        txn.modify(self.REG_CTRL, 0x2140 | self.CTRL_AN_ENABLE, ctrl_reg_val)
 
-        self._phy_modify_reg(bus, self.REG_CTRL, 0, self.CTRL_AN_ENABLE)
+    def enable_sgmii(self, bus, wait=True):
+        # The hardware config mode, fiber/copper auto-selection and
+        # auto-neg changes are all committed by one soft reset
+        txn = self.transaction(bus)
+        self.stage_sgmii(txn)
+        self.stage_autoneg_caps(txn, self.ALL_AUTONEG_CAPS)
+        txn.commit(wait=wait)
 
-        # Commit the auto-neg enablement and advertisement changes
-        self._phy_soft_reset(bus)
+    def set_autoneg_caps(self, bus, speeds, wait=True):
+        txn = self.transaction(bus)
+        self.stage_autoneg_caps(txn, speeds)
+        txn.commit(wait=wait)
 
     def get_linkpartner_caps(self, bus):
         caps = {}
-        an_caps = socket.ntohs(bus.read_word_data(self.PHYADDR, self.REG_LPABIL))
+        (an_caps, gbaset) = [socket.ntohs(v) for v in BasePhy.bus_batch(bus, [
+            (self.OP_READ, self.PHYADDR, self.REG_LPABIL),
+            (self.OP_READ, self.PHYADDR, self.REG_1000BASET_STS),
+        ])]
 
         if an_caps & self.ADV_100FD:
             caps['100full'] = True
@@ -135,7 +156,6 @@ class Marvell88E1111Phy(BasePhy):
         if an_caps & self.ADV_10HD:
             caps['10half'] = True
 
-        gbaset = socket.ntohs(bus.read_word_data(self.PHYADDR, self.REG_1000BASET_STS))
         if gbaset & self.STS_1000FD:
             caps['1000full'] = True
         if gbaset & self.STS_1000HD:
@@ -165,19 +185,24 @@ class Marvell88E1111Phy(BasePhy):
 
         return (link_str, speed, duplex)
 
-    def set_speed_duplex(self, bus, speed, duplex):
-        speed_to_regval = {
-            1000: 0x0040,
-            100: 0x2000,
-            10: 0x0000,
-        }
-        ctrl_reg_val = speed_to_regval[speed]
-        if duplex == 'half':
-            # bit 8 = 0
-            pass
-        else:
-            ctrl_reg_val |= 0x0100
-        self._phy_modify_reg(bus, self.REG_CTRL, 0x2140 | self.CTRL_AN_ENABLE, ctrl_reg_val)
+    def enable_link_interrupts(self, bus):
+        # The interrupt pin isn't used, the interrupt status register
+        # is polled instead
+        self._phy_modify_reg(bus, self.REG_INT_ENABLE,
+                             self.INT_LINK_CHANGE_MASK,
+                             self.INT_LINK_CHANGE_MASK)
+        # Clear anything latched before now
+        bus.read_word_data(self.PHYADDR, self.REG_INT_STATUS)
+        self.link_interrupts_enabled = True
+        return True
+
+    def link_changed(self, bus):
+        if not self.link_interrupts_enabled:
+            return True
+        int_sts = socket.ntohs(bus.read_word_data(self.PHYADDR, self.REG_INT_STATUS))
+        return (int_sts & self.INT_LINK_CHANGE_MASK) != 0
 
-        # Commit the auto-neg disable and forced speed changes
-        self._phy_soft_reset(bus)
+    def set_speed_duplex(self, bus, speed, duplex, wait=True):
+        txn = self.transaction(bus)
+        self.stage_speed_duplex(txn, speed, duplex)
+        txn.commit(wait=wait)
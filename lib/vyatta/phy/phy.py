@@ -9,7 +9,7 @@ import sys
 import time
 import errno
 from vyatta.phy.marvell88e1111 import Marvell88E1111Phy
-from vyatta.phy.basephy import PhyNotFoundException, PhyAccessException
+from vyatta.phy.basephy import BasePhy, PhyNotFoundException, PhyAccessException
 
 class PhyType(object):
     def __init__(self, phyclass):
@@ -44,8 +44,10 @@ class PhyBus:
     @classmethod
     def create_phy(cls, bus):
         try:
-            phyid1 = bus.read_word_data(cls.PHYADDR, cls.PHYID_MSB_REG)
-            phyid2 = bus.read_word_data(cls.PHYADDR, cls.PHYID_LSB_REG)
+            (phyid1, phyid2) = BasePhy.bus_batch(bus, [
+                (BasePhy.OP_READ, cls.PHYADDR, cls.PHYID_MSB_REG),
+                (BasePhy.OP_READ, cls.PHYADDR, cls.PHYID_LSB_REG),
+            ])
         except PhyNotFoundException:
             raise PhyNotFoundException("phy at address 0x%x not found" % cls.PHYADDR)
         except OSError as e:
@@ -5,7 +5,7 @@
 from abc import ABC, abstractmethod
 import time
 from vyatta.phy.phy import PhyBus
-from vyatta.phy.basephy import PhyException
+from vyatta.phy.basephy import BasePhy, PhyException, PhyNotFoundException
 
 class SfpHelperException(Exception):
     pass
@@ -39,6 +39,11 @@ class BaseSfpHelper(ABC):
     PHY_PROBE_TRIES = 1
     PHY_PROBE_RETRY_TIME = 0.075 # 75 msec
 
+    # Number of EEPROM reads that may be in progress at once from
+    # different threads. Helpers that can't be used from more than one
+    # thread at a time should leave this at 1.
+    MAX_CONCURRENT_READS = 1
+
     @abstractmethod
     def get_bus(self, porttype, port):
         """
@@ -80,7 +85,8 @@ class BaseSfpHelper(ABC):
 
         Returns one flat list for all pages in the specified range. If
         length isn't specified then it is assumed that all pages of
-        the EEPROM should be read.
+        the EEPROM should be read. Raises SfpHelperException if the
+        EEPROM can't be read.
         """
         pass
 
@@ -95,6 +101,24 @@ class BaseSfpHelper(ABC):
         """
         pass
 
+    def set_eeprom_cache(self, eeprom_cache):
+        """
+        Set the cache of static EEPROM pages to read through, which is
+        owned by the SFP state manager. Reads made by read_eeprom
+        itself always go to the module.
+        """
+        self._eeprom_cache = eeprom_cache
+
+    def read_cached_eeprom(self, porttype, port, offset=None, length=None):
+        """
+        Reads the EEPROM for the given port via the EEPROM cache, if
+        one has been set.
+        """
+        eeprom_cache = getattr(self, '_eeprom_cache', None)
+        if eeprom_cache is None:
+            return self.read_eeprom(porttype, port, offset, length)
+        return eeprom_cache.read_eeprom(porttype, port, offset, length)
+
     def process_sfpinsertedremoved(self, portname, porttype, port, inserted,
                                    extra_state):
         """
@@ -103,16 +127,72 @@ class BaseSfpHelper(ABC):
         self.sfpd.on_sfp_presence_change(portname, porttype,
                                          port, inserted, extra_state)
 
-    def set_sgmii_enabled(self, porttype, port):
+    def _get_phy_cache(self):
+        # Created on first use, since concrete implementations don't
+        # necessarily call our constructor
+        try:
+            return self._phy_cache
+        except AttributeError:
+            self._phy_cache = {}
+            return self._phy_cache
+
+    def get_phy(self, bus, porttype, port):
+        """
+        Get the driver for the PHY on the given port.
+
+        The PHY is probed the first time and the resulting driver, or
+        the absence of a supported PHY, is remembered until
+        invalidate_phy is called for the port. Raises
+        PhyNotFoundException if there is no supported PHY.
+        """
+        cache = self._get_phy_cache()
+        key = (porttype, port)
+        if key not in cache:
+            try:
+                cache[key] = PhyBus.create_phy(bus)
+            except PhyNotFoundException:
+                cache[key] = None
+                raise
+        phy = cache[key]
+        if phy is None:
+            raise PhyNotFoundException("no supported phy on %s %d" % (porttype, port))
+        return phy
+
+    def probe_phy(self, bus, porttype, port):
+        """
+        Probe for the PHY on the given port regardless of any previous
+        result, remembering the driver if one is found.
+        """
+        phy = PhyBus.create_phy(bus)
+        self._get_phy_cache()[(porttype, port)] = phy
+        return phy
+
+    def invalidate_phy(self, porttype, port):
+        """
+        Forget the PHY driver for the given port, for example because
+        the module has been removed.
+        """
+        self._get_phy_cache().pop((porttype, port), None)
+
+    def set_sgmii_enabled(self, porttype, port, wait=True):
+        """
+        Probe for an SGMII capable PHY on the port and enable SGMII
+        on it, returning whether the PHY is SGMII capable.
+
+        If wait is False then return without waiting for the reset
+        that commits the change, see get_phy_reset_complete.
+        """
         is_sgmii = False
         try:
             for i in range(0, self.PHY_PROBE_TRIES):
                 with self.get_bus(porttype, port) as bus:
                     try:
-                        phy = PhyBus.create_phy(bus)
+                        # The PHY may not have been ready on a
+                        # previous attempt, so always probe
+                        phy = self.probe_phy(bus, porttype, port)
                         is_sgmii = phy.is_sgmii_capable(bus)
                         if is_sgmii:
-                            phy.enable_sgmii(bus)
+                            phy.enable_sgmii(bus, wait=wait)
                             break
                     except PhyException as e:
                         print(e)
@@ -125,43 +205,104 @@ class BaseSfpHelper(ABC):
         """
         Get the link status of any PHY on the port
         """
-        status = ("down", 0, "unknown")
         try:
-            with self.get_bus(porttype, port) as bus:
-                try:
-                    phy = PhyBus.create_phy(bus)
-                    status = phy.get_linkstatus(bus)
-                except PhyException as e:
-                    pass
-        except SfpHelperException as e:
-            pass
-        return status
+            return self.read_phy_link_status(porttype, port)
+        except (PhyException, SfpHelperException) as e:
+            return ("down", 0, "unknown")
+
+    def read_phy_link_status(self, porttype, port):
+        """
+        Read the link status of any PHY on the port
+
+        A port without a supported PHY has its link down. Raises
+        PhyException or SfpHelperException if the PHY can't be
+        accessed, rather than returning a status.
+        """
+        with self.get_bus(porttype, port) as bus:
+            try:
+                phy = self.get_phy(bus, porttype, port)
+            except PhyNotFoundException:
+                return ("down", 0, "unknown")
+            return phy.get_linkstatus(bus)
 
-    def set_phy_speed_duplex(self, porttype, port, speed, duplex):
+    def get_phy_link_change(self, porttype, port):
+        """
+        Get the link status of any PHY on the port, or None if the PHY
+        can tell that it hasn't changed since it was last got this
+        way.
+
+        Link interrupts are enabled on the PHY the first time, so that
+        subsequent calls only need to read the latched changes. Raises
+        PhyException or SfpHelperException if the PHY can't be
+        accessed, as for read_phy_link_status.
+        """
+        with self.get_bus(porttype, port) as bus:
+            try:
+                phy = self.get_phy(bus, porttype, port)
+            except PhyNotFoundException:
+                return ("down", 0, "unknown")
+            try:
+                if not phy.link_interrupts_enabled:
+                    # Changes before now are unknown
+                    phy.enable_link_interrupts(bus)
+                elif not phy.link_changed(bus):
+                    return None
+                return phy.get_linkstatus(bus)
+            except (PhyException, SfpHelperException):
+                # Any change latched has been cleared without the
+                # status being read, so start again next time
+                phy.link_interrupts_enabled = False
+                raise
+
+    def set_phy_speed_duplex(self, porttype, port, speed, duplex, wait=True):
         """
         Set the PHY forced speed and duplex
+
+        If wait is False then don't wait for the PHY reset committing
+        the change to complete, see get_phy_reset_complete. Returns
+        whether the change was made.
         """
         try:
             with self.get_bus(porttype, port) as bus:
                 try:
-                    phy = PhyBus.create_phy(bus)
-                    phy.set_speed_duplex(bus, speed, duplex)
+                    phy = self.get_phy(bus, porttype, port)
+                    phy.set_speed_duplex(bus, speed, duplex, wait=wait)
+                    return True
                 except PhyException as e:
                     pass
         except SfpHelperException as e:
             pass
+        return False
 
-    def set_phy_autoneg(self, porttype, port):
+    def set_phy_autoneg(self, porttype, port, wait=True):
         """
         Set the PHY autonegotiate to on
+
+        If wait is False then don't wait for the PHY reset committing
+        the change to complete, see get_phy_reset_complete. Returns
+        whether the change was made.
         """
         try:
             with self.get_bus(porttype, port) as bus:
                 try:
-                    phy = PhyBus.create_phy(bus)
+                    phy = self.get_phy(bus, porttype, port)
 
-                    phy.set_autoneg_caps(bus, {'1000full': True, '1000half': True, '100full': True, '100half': True, '10full': True, '10half': True })
+                    phy.set_autoneg_caps(bus, BasePhy.ALL_AUTONEG_CAPS, wait=wait)
+                    return True
                 except PhyException as e:
                     pass
         except SfpHelperException as e:
             pass
+        return False
+
+    def get_phy_reset_complete(self, porttype, port):
+        """
+        Has the PHY reset started by a change made with wait=False
+        completed?
+
+        Raises PhyException or SfpHelperException if the PHY can't be
+        accessed.
+        """
+        with self.get_bus(porttype, port) as bus:
+            phy = self.get_phy(bus, porttype, port)
+            return phy.reset_complete(bus)
@@ -9,9 +9,24 @@ import sys
 import subprocess
 import os
 import importlib
+import json
+import re
 
 LOG = logging.getLogger('vyatta.platform.detect')
 
+DMI_SYSFS_DIR = '/sys/class/dmi/id'
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+# Identity of the platform detected during this boot
+DETECT_CACHE_FILE = '/run/vyatta/platform-detect.json'
+
+# dmidecode string keywords and the sysfs attributes with the same
+# information
+DMI_FIELDS = [
+    ('system-manufacturer', 'sys_vendor'),
+    ('system-product-name', 'product_name'),
+    ('bios-version', 'bios_version'),
+]
+
 class PlatformError(Exception):
     pass
 
@@ -46,10 +61,25 @@ class DefaultPlatform(object):
     def __str__(self):
         return self.get_platform_string()
 
-def gen_platform_type_modules():
+def gen_platform_type_entries():
     """
     Generator for found platform type modules (i.e. starting with
-    vyatta.platform.type) in python library paths.
+    vyatta.platform.type) in python library paths, yielding the module
+    name and the path of its manifest, or None if it doesn't have one.
+
+    A platform type module <name>.py can be accompanied by a manifest
+    <name>.json that describes the platforms it detects, so that it
+    only needs to be imported if the platform might be one of them:
+
+    {
+        "match": [
+            {"sysmfr": "<regex>", "sysname": "<regex>"},
+            {"biosver": "<regex>"}
+        ]
+    }
+
+    The module is imported if every regular expression of any of the
+    match entries is found in the corresponding DMI string.
     """
     for path in sys.path:
         type_mod_path = os.path.join(path, 'vyatta', 'platform', 'type')
@@ -59,39 +89,176 @@ def gen_platform_type_modules():
             if (entry.name.endswith('.py') or
                 entry.name.endswith('.pyc')) and entry.is_file():
                 # Strip off extension and prefix with vyatta.platform.type
+                base_name = entry.name.rpartition('.')[0]
                 type_mod_name = '.'.join(['vyatta', 'platform', 'type',
-                                          entry.name.rpartition('.')[0]])
-                yield type_mod_name
-
-def detect():
-    """ Detect platform and return the platform object """
-    sysmfr = subprocess.run(["/usr/sbin/dmidecode", "-s", "system-manufacturer"],
-                            check=True, stdout=subprocess.PIPE,
-                            universal_newlines=True).stdout
-    sysmfr = sysmfr.rstrip('\n')
-    sysname = subprocess.run(["/usr/sbin/dmidecode", "-s", "system-product-name"],
-                             check=True, stdout=subprocess.PIPE,
-                             universal_newlines=True).stdout
-    sysname = sysname.rstrip('\n')
-    # The expected way of identifying a platform is using the system
-    # manufacturer and product name, but often on alpha units these
-    # are not filled in and the best way of identifying Alpha units is
-    # the BIOS version, so extract that so it can be used as well.
-    biosver = subprocess.run(["/usr/sbin/dmidecode", "-s", "bios-version"],
-                             check=True, stdout=subprocess.PIPE,
-                             universal_newlines=True).stdout
-    biosver = biosver.rstrip('\n')
+                                          base_name])
+                manifest = os.path.join(type_mod_path, base_name + '.json')
+                if not os.path.isfile(manifest):
+                    manifest = None
+                yield (type_mod_name, manifest)
+
+def gen_platform_type_modules():
+    """
+    Generator for found platform type modules (i.e. starting with
+    vyatta.platform.type) in python library paths.
+    """
+    for (type_mod_name, _) in gen_platform_type_entries():
+        yield type_mod_name
+
+def manifest_matches(manifest, dmi):
+    """
+    Could the platform with the given DMI strings be one described by
+    the manifest? A manifest that can't be used is assumed to match,
+    so that the module is imported to find out.
+    """
+    try:
+        with open(manifest) as f:
+            matches = json.load(f)['match']
+        for match in matches:
+            if all(re.search(regex, dmi[field])
+                   for (field, regex) in match.items()):
+                return True
+        return False
+    except (OSError, ValueError, KeyError, TypeError, re.error) as e:
+        LOG.debug('ignoring platform type manifest ' + manifest +
+                  ' due to ' + repr(e))
+        return True
+
+def read_dmi_string(keyword, attr):
+    """
+    Read a DMI string, from sysfs if possible, since that is much
+    cheaper than running dmidecode
+    """
+    try:
+        with open(os.path.join(DMI_SYSFS_DIR, attr)) as f:
+            value = f.read().rstrip('\n')
+        if value:
+            return value
+    except OSError:
+        pass
+    # Empty strings are left for dmidecode to describe
+    value = subprocess.run(["/usr/sbin/dmidecode", "-s", keyword],
+                           check=True, stdout=subprocess.PIPE,
+                           universal_newlines=True).stdout
+    return value.rstrip('\n')
+
+def read_boot_id():
+    try:
+        with open(BOOT_ID_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def read_detect_cache(boot_id):
+    """
+    Get the platform identity detected earlier in this boot, or None
+    if there isn't a usable one
+    """
+    if boot_id is None:
+        return None
+    try:
+        with open(DETECT_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get('boot_id') != boot_id:
+        return None
+    if not all(isinstance(cache.get(field), str)
+               for field in ('sysmfr', 'sysname', 'biosver')):
+        return None
+    if not isinstance(cache.get('module'), (str, type(None))):
+        return None
+    return cache
+
+def write_detect_cache(cache):
+    """
+    Remember the platform identity for the rest of this boot. Failing
+    to, for example because of not running as root, isn't an error.
+    """
+    tmp_file = '{}.{}'.format(DETECT_CACHE_FILE, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(DETECT_CACHE_FILE), exist_ok=True)
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, DETECT_CACHE_FILE)
+    except OSError as e:
+        LOG.debug('not caching platform identity due to ' + repr(e))
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
+def detect_module(mod_name, sysmfr, sysname, biosver):
+    """
+    Detect whether the platform is that of the given platform type
+    module, returning the platform object or raising PlatformError
+    """
+    plat_mod = importlib.import_module(mod_name)
+    return plat_mod.detect(sysmfr=sysmfr, sysname=sysname, biosver=biosver)
+
+def detect(use_cache=True):
+    """
+    Detect platform and return the platform object
+
+    The DMI strings and the platform type module that detected the
+    platform are cached for the rest of the boot, so that later calls
+    only need to import and run that module.
+    """
+    boot_id = read_boot_id()
+    cache = read_detect_cache(boot_id) if use_cache else None
+    use_cache = use_cache and boot_id is not None
+    cached = cache is not None
+    if cached:
+        (sysmfr, sysname, biosver) = (cache['sysmfr'], cache['sysname'],
+                                      cache['biosver'])
+        if cache.get('module') and \
+           cache['module'] not in gen_platform_type_modules():
+            LOG.debug('ignoring unknown cached platform ' + cache['module'])
+        elif cache.get('module'):
+            try:
+                return detect_module(cache['module'], sysmfr, sysname,
+                                     biosver)
+            except (ImportError, PlatformError) as e:
+                LOG.debug('cached platform ' + cache['module'] +
+                          ' not detected due to ' + repr(e))
+    else:
+        # The expected way of identifying a platform is using the
+        # system manufacturer and product name, but often on alpha
+        # units these are not filled in and the best way of
+        # identifying Alpha units is the BIOS version, so extract that
+        # so it can be used as well.
+        (sysmfr, sysname, biosver) = [read_dmi_string(keyword, attr)
+                                      for (keyword, attr) in DMI_FIELDS]
     LOG.debug('sysmfr = {}, sysname = {}, biosvr = {}'.format(
         sysmfr, sysname, biosver))
 
-    for mod_name in gen_platform_type_modules():
-        plat_mod = importlib.import_module(mod_name)
+    cache = {
+        'boot_id': boot_id,
+        'sysmfr': sysmfr,
+        'sysname': sysname,
+        'biosver': biosver,
+        'module': None,
+    }
+    dmi = {
+        'sysmfr': sysmfr,
+        'sysname': sysname,
+        'biosver': biosver,
+    }
+    for (mod_name, manifest) in gen_platform_type_entries():
+        if manifest is not None and not manifest_matches(manifest, dmi):
+            LOG.debug('not detected as ' + mod_name + ' due to manifest')
+            continue
         try:
-            platform = plat_mod.detect(sysmfr=sysmfr, sysname=sysname, biosver=biosver)
+            platform = detect_module(mod_name, sysmfr, sysname, biosver)
         except PlatformError as e:
             LOG.debug('not detected as ' + mod_name + ' due to ' + repr(e))
             continue
+        if use_cache:
+            cache['module'] = mod_name
+            write_detect_cache(cache)
         return platform
 
+    if use_cache and not cached:
+        # No need to read the DMI strings again at least
+        write_detect_cache(cache)
     raise PlatformError('no platform detected')
-
@@ -8,11 +8,75 @@ import os
 import select
 import subprocess
 import zmq
+import json
 import base64
+from threading import Lock
 from vyatta.platform.basesfphelper import BaseSfpHelper
 from vyatta.platform.basesfphelper import SfpHelperException
-from vyatta.phy.phy import PhyBus
-from vyatta.phy.basephy import PhyNotFoundException, PhyAccessException
+from vyatta.phy.basephy import BasePhy, PhyException, PhyNotFoundException, PhyAccessException
+
+class ReqSocketPool(object):
+    """Pool of connected REQ sockets to the FAL
+
+    Sockets are connected on first use and kept for subsequent
+    requests, so that a sequence of EEPROM or PHY register accesses
+    doesn't pay for socket setup and connection on every access. A
+    socket is only handed to one caller at a time, so the pool can be
+    shared between threads.
+    """
+
+    # How long to wait for a reply from the FAL, in msec
+    REPLY_TIMEOUT = 5000
+
+    def __init__(self, sfpmgr):
+        self.sfpmgr = sfpmgr
+        self._idle = []
+        self._lock = Lock()
+
+    def _get_socket(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        req_socket = self.sfpmgr.get_req_socket()
+        req_socket.setsockopt(zmq.RCVTIMEO, self.REPLY_TIMEOUT)
+        req_socket.connect(self.sfpmgr.get_req_socket_endpoint())
+        return req_socket
+
+    def request(self, req):
+        """ Send a request to the FAL and return the decoded reply
+
+        Raises SfpHelperException if the FAL doesn't reply in time.
+        """
+        return json.loads(self.request_multipart(req)[0], strict=False)
+
+    def request_multipart(self, req):
+        """ Send a request to the FAL and return the frames of the reply
+
+        Raises SfpHelperException if the FAL doesn't reply in time.
+        """
+        req_socket = self._get_socket()
+        try:
+            req_socket.send_json(req)
+            frames = req_socket.recv_multipart()
+        except zmq.Again:
+            # A REQ socket that is still waiting for its reply can't
+            # send again, so throw it away rather than return it
+            req_socket.close()
+            raise SfpHelperException(
+                "no reply from FAL to {}".format(req['command']))
+        except Exception:
+            req_socket.close()
+            raise
+        with self._lock:
+            self._idle.append(req_socket)
+        return frames
+
+    def close(self):
+        """ Close all idle sockets """
+        with self._lock:
+            for req_socket in self._idle:
+                req_socket.close()
+            self._idle = []
 
 class InprocSfpHelper(BaseSfpHelper):
     """Implement the SFP helper for the platforms that use the Inproc i2x bus
@@ -23,56 +87,137 @@ class InprocSfpHelper(BaseSfpHelper):
     APIs.
 
     """
+    # Each request uses its own socket from the pool and the FAL
+    # serialises access to the i2c bus
+    MAX_CONCURRENT_READS = 8
+
+    # Version of the request/reply protocol we speak to the FAL
+    PROTOCOL_VERSION = 2
+
     def __init__(self, sfpd):
         self.sfpd = sfpd
+        self._req_pool = None
+        # The pool is created on first use, which may be from any of
+        # sfpd's worker threads
+        self._req_pool_lock = Lock()
+        self._fal_capabilities = None
+
+    def get_req_pool(self):
+        """ Get the pool of REQ sockets to the FAL, creating it if needed """
+        with self._req_pool_lock:
+            if self._req_pool is None:
+                self._req_pool = ReqSocketPool(self.sfpd.sfpmgr)
+            return self._req_pool
+
+    def get_fal_capabilities(self):
+        """ Get the optional protocol features supported by the FAL
+
+        The answer is cached once the FAL has replied. A FAL that doesn't
+        reply in time is treated as supporting no optional features, and
+        is asked again next time.
+        """
+        if self._fal_capabilities is None:
+            try:
+                msg = self.get_req_pool().request({
+                    'command': 'CAPABILITIES',
+                    'protocol': self.PROTOCOL_VERSION })
+            except SfpHelperException:
+                return []
+            if msg['result'] == 'OK':
+                self._fal_capabilities = msg.get('capabilities', [])
+            else:
+                # A FAL that predates the CAPABILITIES command
+                self._fal_capabilities = []
+        return self._fal_capabilities
 
     class InprocSfpBus():
         def __init__(self, parent, porttype, port):
             self.porttype = porttype
             self.port = port
-            self.sfpd = parent.sfpd
+            self.parent = parent
+
+        # There is nothing to open or close, but the BaseSfpHelper
+        # methods use the bus as a context manager
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            return False
+
+        def _request(self, phy_req):
+            try:
+                return self.parent.get_req_pool().request(phy_req)
+            except SfpHelperException as e:
+                raise PhyAccessException(str(e)) from e
 
         def read_word_data(self, phyaddr, reg_ctrl):
             """ Request the phy via the ZMQ socket to the FAL """
-            with self.sfpd.sfpmgr.get_req_socket() as req_socket:
-                req_socket.connect(self.sfpd.sfpmgr.get_req_socket_endpoint())
-
-                phy_req = {}
-                phy_req['command'] = 'PHYOPERATION'
-                phy_req['subcmd'] = 'PHYREADWORD'
-                phy_req['porttype'] = self.porttype
-                phy_req['port'] = self.port
-                phy_req['addr'] = phyaddr
-                phy_req['regctrl'] = reg_ctrl
-
-                req_socket.send_json(phy_req);
-                msg = req_socket.recv_json(strict=False)
-
-                if msg['result'] == 'OK':
-                    data = msg['data']
-                    hex_data = int(data, 16)
-                    return hex_data
-                else:
-                    raise PhyNotFoundException("read data result %s" % msg['result'])
+            phy_req = {}
+            phy_req['command'] = 'PHYOPERATION'
+            phy_req['subcmd'] = 'PHYREADWORD'
+            phy_req['porttype'] = self.porttype
+            phy_req['port'] = self.port
+            phy_req['addr'] = phyaddr
+            phy_req['regctrl'] = reg_ctrl
+
+            msg = self._request(phy_req)
+
+            if msg['result'] == 'OK':
+                data = msg['data']
+                hex_data = int(data, 16)
+                return hex_data
+            else:
+                raise PhyNotFoundException("read data result %s" % msg['result'])
 
         def write_word_data(self, phyaddr, reg_ctrl, data):
             """ Request the phy via the ZMQ socket to the FAL """
-            with self.sfpd.sfpmgr.get_req_socket() as req_socket:
-                req_socket.connect(self.sfpd.sfpmgr.get_req_socket_endpoint())
-
-                phy_req = {}
-                phy_req['command'] = 'PHYOPERATION'
-                phy_req['subcmd'] = 'PHYWRITEWORD'
-                phy_req['porttype'] = self.porttype
-                phy_req['port'] = self.port
-                phy_req['addr'] = phyaddr
-                phy_req['regctrl'] = reg_ctrl
-                phy_req['regdata'] = data
-
-                req_socket.send_json(phy_req);
-                msg = req_socket.recv_json(strict=False)
-                if msg['result'] != 'OK':
-                    raise PhyNotFoundException("Write data result %s" % msg['result'])
+            phy_req = {}
+            phy_req['command'] = 'PHYOPERATION'
+            phy_req['subcmd'] = 'PHYWRITEWORD'
+            phy_req['porttype'] = self.porttype
+            phy_req['port'] = self.port
+            phy_req['addr'] = phyaddr
+            phy_req['regctrl'] = reg_ctrl
+            phy_req['regdata'] = data
+
+            msg = self._request(phy_req)
+            if msg['result'] != 'OK':
+                raise PhyNotFoundException("Write data result %s" % msg['result'])
+
+        def batch_word_data(self, ops):
+            """ Request a batch of phy operations in one go from the FAL """
+            if 'phy-batch' not in self.parent.get_fal_capabilities():
+                return BasePhy.bus_ops_singly(self, ops)
+
+            phy_req = {}
+            phy_req['command'] = 'PHYOPERATION'
+            phy_req['subcmd'] = 'PHYBATCH'
+            phy_req['porttype'] = self.porttype
+            phy_req['port'] = self.port
+            phy_req['ops'] = []
+            for op in ops:
+                phy_op = {}
+                phy_op['op'] = op[0]
+                phy_op['addr'] = op[1]
+                phy_op['regctrl'] = op[2]
+                if op[0] == BasePhy.OP_WRITE:
+                    phy_op['regdata'] = op[3]
+                elif op[0] == BasePhy.OP_MODIFY:
+                    phy_op['regmask'] = op[3]
+                    phy_op['regdata'] = op[4]
+                phy_req['ops'].append(phy_op)
+
+            msg = self._request(phy_req)
+
+            if msg['result'] != 'OK':
+                raise PhyNotFoundException("batch result %s" % msg['result'])
+            data = msg.get('data')
+            if not isinstance(data, list) or len(data) != len(ops):
+                raise PhyAccessException(
+                    "batch of {} operations got a reply of {}".format(
+                        len(ops), data))
+            return [int(word, 16) if word is not None else None
+                    for word in data]
 
     def get_bus(self, porttype, port):
         return self.InprocSfpBus(self, porttype, port)
@@ -80,44 +225,46 @@ class InprocSfpHelper(BaseSfpHelper):
     def set_sfp_state(self, portname, enabled):
         pass
 
-    def set_sgmii_enabled(self, porttype, port):
+    def set_sgmii_enabled(self, porttype, port, wait=True):
         is_sgmii = False
         bus = self.get_bus(porttype, port)
         try:
-            phy = PhyBus.create_phy(bus)
+            phy = self.probe_phy(bus, porttype, port)
             is_sgmii = phy.is_sgmii_capable(bus)
             if is_sgmii:
                 try:
-                    phy.enable_sgmii(bus)
+                    phy.enable_sgmii(bus, wait=wait)
                 except Exception as e:
                     return False
-        except PhyNotFoundException as e:
+        except PhyException as e:
             return False
 
         return is_sgmii
 
-    def set_phy_speed_duplex(self, porttype, port, speed, duplex):
+    def set_phy_speed_duplex(self, porttype, port, speed, duplex, wait=True):
         """
         Set the PHY forced speed and duplex mode
         """
         bus = self.get_bus(porttype, port)
         try:
-            phy = PhyBus.create_phy(bus)
-            phy.set_speed_duplex(bus, speed, duplex)
+            phy = self.get_phy(bus, porttype, port)
+            phy.set_speed_duplex(bus, speed, duplex, wait=wait)
+            return True
         except Exception as e:
-            pass
+            return False
 
-    def set_phy_autoneg(self, porttype, port):
+    def set_phy_autoneg(self, porttype, port, wait=True):
         """
         Set the PHY autonegotiate to on
         """
         bus = self.get_bus(porttype, port)
         try:
-            phy = PhyBus.create_phy(bus)
+            phy = self.get_phy(bus, porttype, port)
 
-            phy.set_autoneg_caps(bus, {'1000full': True, '1000half': True, '100full': True, '100half': True, '10full': True, '10half': True })
+            phy.set_autoneg_caps(bus, BasePhy.ALL_AUTONEG_CAPS, wait=wait)
+            return True
         except Exception as e:
-            pass
+            return False
 
     def main_loop(self, file_evmask_tuple_list):
         p = select.poll()
@@ -131,32 +278,48 @@ class InprocSfpHelper(BaseSfpHelper):
                 self.sfpd.on_file_event(fd, event)
 
     def read_eeprom(self, porttype, port, offset=None, length=None):
-        """ Request the eeprom via the ZMQ socket to the FAL """
-        with self.sfpd.sfpmgr.get_req_socket() as req_socket:
-            req_socket.connect(self.sfpd.sfpmgr.get_req_socket_endpoint())
-
-            eeprom_req = {}
-            eeprom_req['command'] = 'SFPREADEEPROM'
-            eeprom_req['porttype'] = porttype
-            eeprom_req['port'] = port
-            if offset:
-                eeprom_req['offset'] = offset
-            else:
-                eeprom_req['offset'] = 0
-
-            if length:
-                eeprom_req['length'] = length
-            else:
-                eeprom_req['length'] = 0
+        """ Request the eeprom via the ZMQ socket to the FAL
 
-            req_socket.send_json(eeprom_req);
-            msg = req_socket.recv_json(strict=False)
+        Raises SfpHelperException if there is no module or the FAL
+        doesn't reply in time.
+        """
+        eeprom_req = {}
+        eeprom_req['command'] = 'SFPREADEEPROM'
+        eeprom_req['porttype'] = porttype
+        eeprom_req['port'] = port
+        if offset:
+            eeprom_req['offset'] = offset
+        else:
+            eeprom_req['offset'] = 0
 
-            if msg['result'] == 'OK':
-                data = base64.b64decode(msg['data'])
-                return bytes(data)
-            elif msg['result'] == 'NOSFP':
-                raise SfpHelperException
+        if length:
+            eeprom_req['length'] = length
+        else:
+            eeprom_req['length'] = 0
+
+        binary = 'binary-eeprom' in self.get_fal_capabilities()
+        if binary:
+            eeprom_req['encoding'] = 'binary'
+
+        frames = self.get_req_pool().request_multipart(eeprom_req)
+        msg = json.loads(frames[0], strict=False)
+
+        if msg['result'] == 'OK':
+            if binary:
+                if len(frames) < 2:
+                    raise SfpHelperException(
+                        "no EEPROM data in FAL reply for {} {}".format(
+                            porttype, port))
+                if 'length' in msg and len(frames[1]) != msg['length']:
+                    raise SfpHelperException(
+                        "{} bytes of EEPROM data in FAL reply for {} {}, "
+                        "expected {}".format(len(frames[1]), porttype, port,
+                                             msg['length']))
+                return bytes(frames[1])
+            data = base64.b64decode(msg['data'])
+            return bytes(data)
+        elif msg['result'] == 'NOSFP':
+            raise SfpHelperException
 
     def query_eeprom(self, porttype, port):
         """Get the set of pages that the spf has
@@ -169,7 +332,8 @@ class InprocSfpHelper(BaseSfpHelper):
         pages = []
         if porttype == 'SFP':
 
-            data = self.read_eeprom(porttype, port, self.DMT_BYTE, 1)
+            # The DMT byte is in A0h, so go via the EEPROM cache
+            data = self.read_cached_eeprom(porttype, port, self.DMT_BYTE, 1)
             if (data):
                 pages.append(0xa0)
                 dmt_imp = data[0] & (self.DMT_IMPL|self.DMT_ADDR_CHNG_REQ) == self.DMT_IMPL
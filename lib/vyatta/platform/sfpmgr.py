@@ -9,10 +9,17 @@ import os
 import base64
 import systemd.daemon
 import logging
+import queue
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from vyatta.phy.basephy import PhyException
 from vyatta.platform.basesfphelper import SfpHelperException
 from vyatta.platform.basesfphelper import ModuleNotPresentException
 from vyatta.proto import SFPMonitor_pb2
-from threading import Event, Thread
+from threading import Event, Lock, RLock, Thread
+from contextlib import nullcontext
 
 dbg = logging.debug
 info = logging.info
@@ -26,27 +33,199 @@ class SfpState:
         self.state['type'] = porttype
         self.state['port'] = port
 
+class SfpModuleDescriptor(object):
+    '''
+    Metadata of a module, decoded from a single read of its base ID
+    page: bytes 0-127 of A0h for SFPs and upper page 00h for QSFPs
+
+    extra_state is the state published for the module and the vendor
+    fields are those recorded in the presence file.
+    '''
+
+    # Offset and length of the base ID page of each port type
+    BASE_PAGE = {
+        'SFP': (0, 128),
+        'QSFP': (128, 128),
+    }
+
+    # Offsets of vendor name, OUI, part number and revision, and the
+    # end of the revision
+    VENDOR_FIELDS = {
+        'SFP': (20, 37, 40, 56, 60),
+        'QSFP': (148, 165, 168, 184, 186),
+    }
+
+    def __init__(self, porttype, port, data):
+        self.porttype = porttype
+        self.port = port
+        self.base = self.BASE_PAGE[porttype][0]
+        self.data = data
+        self.extra_state = {}
+        if porttype == 'SFP':
+            self._decode_sfp_extra_state()
+        else:
+            self._decode_qsfp_extra_state()
+        self._decode_vendor_fields()
+
+    def _byte(self, offset):
+        return self.data[offset - self.base]
+
+    def _str(self, start, end):
+        return self.data[start - self.base:end - self.base].decode(
+            'utf-8', 'replace').rstrip()
+
+    def _decode_sfp_extra_state(self):
+        eth_10g = self._byte(3)
+        eth_compat = self._byte(6)
+        eth_extended_comp = self._byte(36)
+        sff_8472_comp = self._byte(94)
+        self.extra_state['eeprom_eth_10g'] = eth_10g
+        self.extra_state['eeprom_eth_compat'] = eth_compat
+        self.extra_state['eeprom_eth_extended_comp'] = eth_extended_comp
+
+        # SFF 8472 compliance
+        if sff_8472_comp > 0x00 and sff_8472_comp < 0x0A:
+            self.extra_state['has_diag'] = True
+        else:
+            self.extra_state['has_diag'] = False
+
+    def _decode_qsfp_extra_state(self):
+        # SFF-8636 Extended Identifier
+        self.extra_state['rx_cdr_present'] = True if self._byte(129) & 0x4 else False
+
+        eth_1040100g = self._byte(131)
+        eth_extended_comp = self._byte(192)
+        self.extra_state['eeprom_eth_1040100g'] = eth_1040100g
+        # SFF_8636_EXT_COMPLIANCE
+        if eth_1040100g & 0x80:
+            self.extra_state['eeprom_eth_extended_comp'] = eth_extended_comp
+
+        if self._byte(147) & 0x0F < 0xA: # Fibre QSFP
+            self.extra_state['has_diag'] = True
+        else: # Copper QSFP
+            self.extra_state['has_diag'] = False
+
+    def _decode_vendor_fields(self):
+        (name, oui, part, rev, end) = self.VENDOR_FIELDS[self.porttype]
+        self.vendor_name = self._str(name, oui - 1)
+        self.vendor_oui = self.data[oui - self.base:part - self.base].hex()
+        self.vendor_part_id = self._str(part, rev)
+        self.vendor_rev = self._str(rev, end)
+
+class SfpEepromCache(object):
+    '''
+    Cache of the static EEPROM pages of SFPs and QSFPs
+
+    The base ID page of a module (A0h for SFPs, upper page 00h for
+    QSFPs) doesn't change while the module stays seated, so it's read
+    from the module once and subsequent reads that fall entirely
+    within it are served from memory. Reads of any other range, such
+    as the A2h diagnostics or the QSFP lower page, always go to the
+    module.
+
+    May be used from any thread.
+    '''
+
+    # Cacheable pages per port type, as page -> (offset, length) in
+    # the flat address space used by read_eeprom
+    STATIC_PAGES = {
+        'SFP': {
+            0xa0: (0, 256),
+        },
+        'QSFP': {
+            0x00: (128, 128),
+        },
+    }
+
+    def __init__(self, sfphelper):
+        self.sfphelper = sfphelper
+        self._pages = {}
+        # Protects _pages, but isn't held while reading the module
+        self._lock = Lock()
+
+    def _find_page(self, porttype, offset, length):
+        for page, (start, size) in self.STATIC_PAGES.get(porttype, {}).items():
+            if offset >= start and offset + length <= start + size:
+                return page, start, size
+        return None, None, None
+
+    def read_eeprom(self, porttype, port, offset=None, length=None):
+        '''
+        Read the EEPROM of the given port, serving it from the cache
+        if the range is within a static page
+        '''
+        if not length:
+            # Whole EEPROM requested, which includes volatile pages
+            return self.sfphelper.read_eeprom(porttype, port, offset, length)
+        if offset is None:
+            offset = 0
+
+        page, start, size = self._find_page(porttype, offset, length)
+        if page is None:
+            return self.sfphelper.read_eeprom(porttype, port, offset, length)
+
+        key = (porttype, port, page)
+        with self._lock:
+            data = self._pages.get(key)
+        if data is None:
+            data = self.sfphelper.read_eeprom(porttype, port, start, size)
+            if data is None:
+                return None
+            # Don't cache short reads
+            if len(data) == size:
+                with self._lock:
+                    self._pages[key] = data
+        return data[offset - start:offset - start + length]
+
+    def invalidate(self, porttype, port):
+        '''
+        Drop all cached pages for the given port
+        '''
+        with self._lock:
+            for key in [k for k in self._pages
+                        if k[0] == porttype and k[1] == port]:
+                del self._pages[key]
+
 class SFPMonitorTimer(Thread):
+    '''
+    SFP monitoring worker
+
+    Collects and publishes SFP status in its own thread, so that
+    commands on the REP socket aren't held up by the EEPROM sweep.
+    '''
+
+    description = "SFP monitoring"
+
     def __init__(self, mgr):
-        Thread.__init__(self)
+        Thread.__init__(self, daemon=True)
         self.stopped = Event()
+        self.wakeup = Event()
         self.mgr = mgr
-        self.req_socket = mgr.get_req_socket()
-        endpoint = mgr.get_rep_socket_endpoint()
-        self.req_socket.connect(endpoint)
         self.status_interval = None
 
     def run(self):
         '''
-        Trigger sfp monitoring at interval if the interval is
-        not None.
+        Run sfp monitoring at interval if the interval is
+        not None, or when triggered.
         '''
-        while not self.stopped.wait(self.status_interval):
-            self.req_socket.send_json({ 'command': 'SFPMONITORTRIGGER'})
-            msg = self.req_socket.recv_json(strict=False)
+        while True:
+            self.wakeup.wait(self.status_interval)
+            if self.stopped.is_set():
+                break
+            self.wakeup.clear()
+            try:
+                self.poll()
+            except Exception as e:
+                info("{} failed: {}".format(self.description, e))
+
+    def poll(self):
+        self.mgr.run_sfp_monitor()
 
-            if msg['result'] != 'OK':
-                dbg("SFP monitoring trigger not accepted")
+    def trigger(self):
+        '''
+        Run sfp monitoring now rather than waiting for the interval
+        '''
+        self.wakeup.set()
 
     def setInterval(self, newTime):
         '''
@@ -62,6 +241,74 @@ class SFPMonitorTimer(Thread):
         '''
         dbg("Stopping SFPMonitorTimer thread")
         self.stopped.set()
+        self.wakeup.set()
+
+class PhyLinkMonitor(SFPMonitorTimer):
+    '''
+    PHY link monitoring worker
+
+    Polls the link status of the PHYs on present ports at an interval,
+    so that PHYLINKSTATUS can be answered without reading the PHYs and
+    link changes are published as they are seen.
+    '''
+
+    description = "PHY link monitoring"
+
+    def poll(self):
+        self.mgr.run_phy_link_monitor()
+
+class PhyResetTracker(Thread):
+    '''
+    Tracks the PHY resets started by asynchronous PHY configuration
+    commands, polling each until it completes or times out and then
+    publishing the outcome on the phyconfig topic.
+    '''
+
+    # From 802.3 22.2.4.1.1: The reset process shall be completed
+    # within 0.5 s from the setting of bit 0.15
+    # So we shoot a bit over to 0.525s, polling every 75ms
+    RESET_TIMEOUT = 0.525
+    POLL_INTERVAL = 0.075
+
+    def __init__(self, mgr):
+        Thread.__init__(self, daemon=True)
+        self.mgr = mgr
+        self.pending = {}
+        self.lock = Lock()
+        self.wakeup = Event()
+
+    def track(self, portname, porttype, port, operation):
+        '''
+        Start tracking the reset of the PHY on the given port. Any
+        reset already being tracked for the port is superseded.
+        '''
+        with self.lock:
+            self.pending[portname] = (porttype, port, operation,
+                                      time.monotonic() + self.RESET_TIMEOUT)
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.POLL_INTERVAL)
+            with self.lock:
+                pending = list(self.pending.items())
+            for portname, entry in pending:
+                (porttype, port, operation, deadline) = entry
+                with self.mgr.phy_access(porttype, port):
+                    result = self.mgr.poll_phy_reset(porttype, port, deadline)
+                if result is None:
+                    continue
+                with self.lock:
+                    if self.pending.get(portname) is not entry:
+                        # Superseded while being polled
+                        continue
+                    del self.pending[portname]
+                self.mgr.run_on_main(partial(self.mgr.publish_phy_config_event,
+                                             portname, operation, result))
+            with self.lock:
+                if not self.pending:
+                    self.wakeup.clear()
 
 class SfpStateManager(object):
     '''
@@ -71,6 +318,35 @@ class SfpStateManager(object):
     changes via ZMQ, and allows those parties to also enact changes to
     the state of SFPs.
     '''
+
+    # Default number of monitoring ticks between full snapshots when
+    # in delta monitoring mode
+    MONITOR_FULL_REFRESH_TICKS = 10
+
+    # Commands that can take a long time, for example due to PHY
+    # resets, and so are processed by command workers
+    WORKER_COMMANDS = frozenset([
+        'PHYLINKSTATUS',
+        'PHYSPEEDDUPLEXSET',
+        'PHYAUTONEGSET',
+        'SFPREADEEPROM',
+        'SFPQUERYEEPROM',
+    ])
+    COMMAND_WORKERS = 4
+    SGMII_WORKERS = 4
+
+    # Number of sfp topic publications kept for REPLAY since
+    EVENT_LOG_SIZE = 256
+
+    # Version of the request/reply protocol and optional features,
+    # which clients can discover with the CAPABILITIES command.
+    # Version 1 is the original JSON-only protocol.
+    PROTOCOL_VERSION = 2
+    CAPABILITIES = [
+        # SFPREADEEPROM with 'encoding': 'binary' replies with a JSON
+        # header frame followed by a frame of raw EEPROM bytes
+        'binary-eeprom',
+    ]
     def __init__(self, pub_endpoint, rep_endpoint, req_endpoint, sfphelper, monitor_socket, sfpd_monitor=None):
         self._ctx = zmq.Context.instance()
         self._ctx.IPV6 = 1
@@ -81,7 +357,9 @@ class SfpStateManager(object):
             # Make it user/group readable/writable so it's possible
             # for clients not running as the same user to use it
             os.chmod(pub_endpoint[6:], 0o770)
-        self.rep_socket = self._ctx.socket(zmq.REP)
+        # A ROUTER rather than a REP socket, so that many client
+        # requests can be outstanding at once
+        self.rep_socket = self._ctx.socket(zmq.ROUTER)
         listen_fds = systemd.daemon.listen_fds()
         if len(listen_fds) >= 1:
             self.rep_socket.set(zmq.USE_FD, listen_fds[0])
@@ -91,30 +369,72 @@ class SfpStateManager(object):
             # for clients not running as the same user to use it
             os.chmod(rep_endpoint[6:], 0o770)
         self.sfp_state = {}
+        # Statistics returned by the STATS command
+        self.stats = {}
+        # The document returned by REPLAY, kept up to date as the
+        # state changes, and its encoding once a client has asked
+        self._replay_doc = {}
+        self._replay_bytes = None
+        # Sequence numbers and log of sfp topic publications, for
+        # clients catching up on what they missed. The epoch is unique
+        # to this process, rather than being sfpd's presence epoch,
+        # which starts again at 0 if the presence file is lost, so that
+        # a client's sequence number from a previous process always
+        # gets a full replay. It's the start time in microseconds, to
+        # stay exact for clients holding JSON numbers as doubles.
+        self.epoch = time.time_ns() // 1000
+        self._event_seq = 0
+        self._event_log = deque(maxlen=self.EVENT_LOG_SIZE)
         self.sfphelper = sfphelper
+        self.eeprom_cache = SfpEepromCache(sfphelper)
+        if sfphelper is not None:
+            sfphelper.set_eeprom_cache(self.eeprom_cache)
         self._req_endpoint = req_endpoint
         self._rep_endpoint = rep_endpoint
         self.monitor_socket = monitor_socket
+        # The monitor socket is written to by both the monitoring
+        # worker and the main thread
+        self.monitor_lock = Lock()
+        # Helpers that can't be used from more than one thread at a
+        # time are serialised between the command path and the
+        # monitoring worker
+        if sfphelper is not None and sfphelper.MAX_CONCURRENT_READS > 1:
+            self.io_lock = nullcontext()
+        else:
+            self.io_lock = RLock()
+        # Locks serialising access to the PHY on each port, by
+        # (porttype, port), since PHY changes are made by multi-step
+        # register sequences that mustn't be interleaved
+        self._phy_locks = {}
+        self._phy_locks_lock = Lock()
         self.timer = None
+        # Latest PHY link status of each port, kept up to date by the
+        # PHY link monitor while it is running
+        self.phy_link_monitor = None
+        self.phy_link_state = {}
+        self.phy_link_lock = Lock()
         self.sfpd_monitor_callback = sfpd_monitor
-
-    def _dict_merge(self, a, b, path=None):
-        '''
-        Performs a deep merge of dictionary b into a
-        '''
-        if path is None: path = []
-        for key in b:
-            if key in a:
-                if isinstance(a[key], dict) and isinstance(b[key], dict):
-                    self._dict_merge(a[key], b[key], path + [str(key)])
-                elif a[key] == b[key]:
-                    pass # same leaf value
-                else:
-                    raise Exception(
-                        'Conflict at %s' % '.'.join(path + [str(key)]))
-            else:
-                a[key] = b[key]
-        return a
+        # Delta monitoring state: when enabled only ports whose
+        # status bytes changed since they were last published are
+        # sent, with a full snapshot every monitor_full_refresh ticks
+        self.monitor_delta = False
+        self.monitor_full_refresh = self.MONITOR_FULL_REFRESH_TICKS
+        self._monitor_ticks = 0
+        self._monitor_full_pending = True
+        self._monitor_published = {}
+        # Calls to be made from the main thread, for example to send
+        # the replies of command workers, and a pipe to wake the main
+        # loop up when there are some
+        self._main_calls = queue.Queue()
+        self._main_calls_rfd, self._main_calls_wfd = os.pipe()
+        os.set_blocking(self._main_calls_rfd, False)
+        self._command_executor = ThreadPoolExecutor(
+            max_workers=self.COMMAND_WORKERS)
+        # Workers bringing up the SGMII PHYs of inserted modules
+        self._sgmii_executor = ThreadPoolExecutor(
+            max_workers=self.SGMII_WORKERS)
+        self.phy_reset_tracker = PhyResetTracker(self)
+        self.phy_reset_tracker.start()
 
     def _serialise_sfp_state(self, portname, presence, sfp_state):
         '''
@@ -130,52 +450,38 @@ class SfpStateManager(object):
         state['ports'][portname].update(sfp_state.state)
         return state
 
-    def _sfp_eeprom_get_extra_state(self, port, sfp_state):
-        try:
-            content = self.sfphelper.read_eeprom('SFP', port, offset=0, length=128)
-            eth_10g = content[3]
-            eth_compat = content[6]
-            eth_extended_comp = content[36]
-            sff_8472_comp = content[94]
-            sfp_state['eeprom_eth_10g'] = eth_10g
-            sfp_state['eeprom_eth_compat'] = eth_compat
-            sfp_state['eeprom_eth_extended_comp'] = eth_extended_comp
-
-            # SFF 8472 compliance
-            if sff_8472_comp > 0x00 and sff_8472_comp < 0x0A:
-                sfp_state['has_diag'] = True
-            else:
-                sfp_state['has_diag'] = False
-        except SfpHelperException:
-            # Module was removed in between notification it was
-            # inserted and retrieval of information, or no EEPROM
-            # information is present. Either way, to be expected so
-            # eat the exception and return no extra state
-            pass
+    def read_eeprom(self, porttype, port, offset=None, length=None):
+        '''
+        Read the EEPROM of the given port via the EEPROM cache
+        '''
+        return self.eeprom_cache.read_eeprom(porttype, port, offset, length)
+
+    def invalidate_eeprom_cache(self, porttype, port):
+        '''
+        Forget any cached EEPROM contents for the given port
+        '''
+        self.eeprom_cache.invalidate(porttype, port)
+
+    def read_module_descriptor(self, porttype, port):
+        '''
+        Read the base ID page of the module in the given port and
+        decode it into a module descriptor
 
-    def _qsfp_eeprom_get_extra_state(self, port, sfp_state):
+        Returns None if the page can't be read, for example because
+        the module was removed in between notification it was inserted
+        and retrieval of information, or because it has no EEPROM.
+        '''
+        if porttype not in SfpModuleDescriptor.BASE_PAGE:
+            return None
+        (offset, length) = SfpModuleDescriptor.BASE_PAGE[porttype]
         try:
-            content = self.sfphelper.read_eeprom('QSFP', port, offset=0, length=256)
-            # SFF-8636 Extended Identifier
-            sfp_state['rx_cdr_present'] = True if content[129] & 0x4 else False
-
-            eth_1040100g = content[131]
-            eth_extended_comp = content[192]
-            sfp_state['eeprom_eth_1040100g'] = eth_1040100g
-            # SFF_8636_EXT_COMPLIANCE
-            if eth_1040100g & 0x80:
-                sfp_state['eeprom_eth_extended_comp'] = eth_extended_comp
-
-            if content[147] & 0x0F < 0xA: # Fibre QSFP
-                sfp_state['has_diag'] = True
-            else: # Copper QSFP
-                sfp_state['has_diag'] = False
+            data = self.read_eeprom(porttype, port, offset=offset,
+                                    length=length)
         except SfpHelperException:
-            # Module was removed in between notification it was
-            # inserted and retrieval of information, or no EEPROM
-            # information is present. Either way, to be expected so
-            # eat the exception and return no extra state
-            pass
+            return None
+        if data is None or len(data) < length:
+            return None
+        return SfpModuleDescriptor(porttype, port, data)
 
     def _may_support_sgmii(self, sfp_state):
         # 100BASE-FX, 100BASE-LX/LX10 or 1000BASE-T
@@ -193,109 +499,452 @@ class SfpStateManager(object):
         return False
 
     def on_sfp_presence_change(self, portname, porttype, port, presence,
-                               extra_state):
+                               extra_state, descriptor=None):
         '''
         Notifies the SFP manager that the presence of an SFP has
         changed
 
         portname should represent the name of the port in the system
         minus the dp<n> prefix. porttype should be either 'SFP' or
-        'QSFP'.
+        'QSFP'. If the caller has already read the module descriptor of
+        an inserted module it can pass it in, rather than it being
+        read again.
         '''
-        topic = "sfp"
+        extra_state = self.prepare_sfp_state(porttype, port, presence,
+                                             extra_state, descriptor)
+        self.commit_sfp_state(portname, porttype, port, presence,
+                              extra_state)
+
+    def prepare_sfp_state(self, porttype, port, presence, extra_state,
+                          descriptor=None):
+        '''
+        The part of processing a presence change that accesses the
+        module, returning the extra state to commit
 
+        May be called from any thread, with helper access.
+        '''
         if not extra_state:
             extra_state = {}
-            if porttype == 'SFP':
-                self._sfp_eeprom_get_extra_state(port, extra_state)
-            elif porttype == 'QSFP':
-                self._qsfp_eeprom_get_extra_state(port, extra_state)
+            if presence and descriptor is None:
+                descriptor = self.read_module_descriptor(porttype, port)
+            if presence and descriptor is not None:
+                extra_state = dict(descriptor.extra_state)
+        return extra_state
+
+    def commit_sfp_state(self, portname, porttype, port, presence,
+                         extra_state):
+        '''
+        Record and publish the new state of a port whose presence has
+        changed
+
+        The presence of an inserted module is published straight away.
+        If it might have an SGMII PHY then the PHY is brought up in the
+        background, and the state published again with sgmii_enabled
+        if that succeeds.
+        '''
+        sfp_state = SfpState(porttype, port, extra_state)
+        if presence:
+            with self.phy_link_lock:
+                self.sfp_state[portname] = sfp_state
+                self.phy_link_state.pop(portname, None)
+        else:
+            self.invalidate_eeprom_cache(porttype, port)
+            self.sfphelper.invalidate_phy(porttype, port)
+            with self.phy_link_lock:
+                if portname in self.sfp_state:
+                    del self.sfp_state[portname]
+                self.phy_link_state.pop(portname, None)
+        self._publish_sfp_state(portname, presence, sfp_state)
 
         # We can't tell if sgmii is supported by reading the eeprom so
         # try to enable it to find out if it is supported.
         if presence and self._may_support_sgmii(extra_state) and \
-           self.sfphelper.set_sgmii_enabled(porttype, port):
-            extra_state['sgmii_enabled'] = True
-        if 'sgmii_enabled' in extra_state and extra_state['sgmii_enabled']:
-            info("%s %d is SGMII capable" % (porttype, port))
+           not extra_state.get('sgmii_enabled', False):
+            self._sgmii_executor.submit(self._enable_sgmii, portname,
+                                        sfp_state)
+
+    def _enable_sgmii(self, portname, sfp_state):
+        '''
+        Try to bring up an SGMII PHY on an inserted module, in a
+        worker, and arrange for the outcome to be committed from the
+        main thread
+        '''
+        porttype = sfp_state.state['type']
+        port = sfp_state.state['port']
+        try:
+            # Serialised with any other bring-up of a module in the
+            # same port and with PHY configuration commands
+            with self.phy_access(porttype, port):
+                if self.sfp_state.get(portname) is not sfp_state:
+                    # Removed or replaced while waiting
+                    return
+                with self.helper_access():
+                    enabled = self.sfphelper.set_sgmii_enabled(
+                        porttype, port, wait=False)
+                if enabled:
+                    # Other ports can use the helper during the reset
+                    result = self._wait_phy_reset(porttype, port)
+                    if result != 'OK':
+                        info("Failed to enable SGMII on %s %d: %s" %
+                             (porttype, port, result))
+                        return
+        except Exception as e:
+            info("Failed to enable SGMII on %s %d: %s" % (porttype, port, e))
+            return
+        if enabled:
+            self.run_on_main(partial(self._commit_sgmii_enabled, portname,
+                                     sfp_state))
+
+    def _commit_sgmii_enabled(self, portname, sfp_state):
+        if self.sfp_state.get(portname) is not sfp_state:
+            # The module has since been removed or replaced
+            return
+        porttype = sfp_state.state['type']
+        port = sfp_state.state['port']
+        info("%s %d is SGMII capable" % (porttype, port))
+        sfp_state.state['sgmii_enabled'] = True
+        self._publish_sfp_state(portname, True, sfp_state)
+
+    def _publish_sfp_state(self, portname, presence, sfp_state):
+        '''
+        Publish the state of a port on the sfp topic
+
+        Each publication is stamped with the next sequence number and
+        the event log epoch, and kept in the event log so that clients can
+        catch up with a REPLAY since a sequence number.
+        '''
+        topic = "sfp"
 
-        sfp_state = SfpState(porttype, port, extra_state)
-        if presence:
-            self.sfp_state[portname] = sfp_state
-        elif portname in self.sfp_state:
-            del self.sfp_state[portname]
         state = self._serialise_sfp_state(portname, presence,
                                           sfp_state)
+        self._update_replay_state(portname, presence,
+                                  state['ports'][portname])
+        self._event_seq += 1
+        state['seq'] = self._event_seq
+        state['epoch'] = self.epoch
+        self._event_log.append(state)
         self.pub_socket.send_string(topic + ' ' + json.dumps(state))
 
-    def _process_replay_command(self):
+    def _update_replay_state(self, portname, presence, port_state):
+        '''
+        Update the document returned by REPLAY with the state of a port
+        '''
+        ports = self._replay_doc.setdefault('ports', {})
+        if presence:
+            ports[portname] = port_state
+        else:
+            ports.pop(portname, None)
+        if not ports:
+            del self._replay_doc['ports']
+        # Encoded again on the next REPLAY
+        self._replay_bytes = None
+
+    def _process_replay_command(self, json):
         '''
         Process a request for a replay of SFP state from a client
+
+        If the request has a 'since' sequence number, and an 'epoch'
+        which is the current one, then just the events after that
+        sequence number are returned if the event log still has them
+        all. Otherwise the full state is returned, marked with the
+        current epoch and sequence number.
         '''
-        all_sfp_state = {}
-        for portname, sfp_state in self.sfp_state.items():
-            self._dict_merge(all_sfp_state, self._serialise_sfp_state(
-                portname, True, sfp_state))
-        self.rep_socket.send_json(all_sfp_state)
+        if 'since' in json:
+            return self._replay_since(int(json['since']), json.get('epoch'))
+        return self._get_replay_bytes()
+
+    def _get_replay_bytes(self):
+        if self._replay_bytes is None:
+            self._replay_bytes = json.dumps(self._replay_doc).encode()
+        return self._replay_bytes
+
+    def _replay_since(self, since, epoch):
+        reply = {
+            'epoch': self.epoch,
+            'seq': self._event_seq,
+        }
+        if epoch == self.epoch and since <= self._event_seq and \
+           (since == self._event_seq or
+            (self._event_log and self._event_log[0]['seq'] <= since + 1)):
+            reply['full'] = False
+            reply['events'] = [event for event in self._event_log
+                               if event['seq'] > since]
+        else:
+            reply['full'] = True
+            reply.update(self._replay_doc)
+        return reply
 
-    def _process_phylinkstatus_command(self):
+    def _process_phylinkstatus_command(self, json):
         '''
         Process a request for the PHY link status from a client
+
+        While the PHY link monitor is running the status it last read
+        is returned, unless the request has 'fresh' set, in which case
+        the status is read from the PHYs.
         '''
+        fresh = json.get('fresh', False) or \
+            not self.phy_link_monitor_running()
         all_phylinkstatus_state = {}
         all_phylinkstatus_state['phy_links'] = {}
-        for portname, sfp_state in self.sfp_state.items():
+        for portname, sfp_state in list(self.sfp_state.items()):
             if self.sfphelper:
-                (link, speed, duplex) = self.sfphelper.get_phy_link_status(
-                    sfp_state.state['type'], sfp_state.state['port'])
+                status = None
+                if not fresh:
+                    status = self.phy_link_state.get(portname)
+                if status is None:
+                    status = self._update_phy_link_status(portname,
+                                                          sfp_state)
+                if status is None:
+                    # The PHY couldn't be read
+                    status = ("down", 0, "unknown")
+                (link, speed, duplex) = status
                 phy_link_dict = {}
                 phy_link_dict['link'] = link
                 phy_link_dict['speed'] = speed
                 phy_link_dict['duplex'] = duplex
                 all_phylinkstatus_state['phy_links'][portname] = phy_link_dict
-        self.rep_socket.send_json(all_phylinkstatus_state)
+        return all_phylinkstatus_state
 
     def _process_physpeedduplexset_command(self, json):
         speed = json['speed']
         duplex = json['duplex']
         portname = json['portname']
         if not portname in self.sfp_state:
-            self.rep_socket.send_json({ 'result': 'SFP not present'})
-            return
+            return { 'result': 'SFP not present'}
 
         sfp_state = self.sfp_state[portname]
         porttype = sfp_state.state['type']
         port = sfp_state.state['port']
 
-        self.sfphelper.set_phy_speed_duplex(porttype, port, speed, duplex)
-        self.rep_socket.send_json({ 'result': 'OK' })
+        if json.get('async', False):
+            with self.phy_access(porttype, port), self.helper_access():
+                pending = self.sfphelper.set_phy_speed_duplex(porttype, port,
+                                                              speed, duplex,
+                                                              wait=False)
+            if pending:
+                self.phy_reset_tracker.track(portname, porttype, port,
+                                             'PHYSPEEDDUPLEXSET')
+            return { 'result': 'OK', 'pending': pending }
+
+        with self.phy_access(porttype, port):
+            with self.helper_access():
+                pending = self.sfphelper.set_phy_speed_duplex(porttype, port,
+                                                              speed, duplex,
+                                                              wait=False)
+            if pending:
+                return { 'result': self._wait_phy_reset(porttype, port) }
+        return { 'result': 'OK' }
 
     def _process_phyautonegset_command(self, json):
         portname = json['portname']
         if not portname in self.sfp_state:
-            self.rep_socket.send_json({ 'result': 'SFP not present'})
-            return
+            return { 'result': 'SFP not present'}
 
         sfp_state = self.sfp_state[portname]
         porttype = sfp_state.state['type']
         port = sfp_state.state['port']
 
-        self.sfphelper.set_phy_autoneg(porttype, port)
-        self.rep_socket.send_json({ 'result': 'OK' })
+        if json.get('async', False):
+            with self.phy_access(porttype, port), self.helper_access():
+                pending = self.sfphelper.set_phy_autoneg(porttype, port,
+                                                         wait=False)
+            if pending:
+                self.phy_reset_tracker.track(portname, porttype, port,
+                                             'PHYAUTONEGSET')
+            return { 'result': 'OK', 'pending': pending }
+
+        with self.phy_access(porttype, port):
+            with self.helper_access():
+                pending = self.sfphelper.set_phy_autoneg(porttype, port,
+                                                         wait=False)
+            if pending:
+                return { 'result': self._wait_phy_reset(porttype, port) }
+        return { 'result': 'OK' }
+
+    def poll_phy_reset(self, porttype, port, deadline):
+        '''
+        Poll the PHY reset started on the given port by a change made
+        with wait=False, returning 'OK' once it has completed, the
+        error if it failed or timed out, or None if it is still in
+        progress. Called with phy_access held for the port.
+
+        The PHY driver is dropped on failure, since the PHY may not be
+        in the state it was believed to be.
+        '''
+        try:
+            with self.helper_access():
+                if self.sfphelper.get_phy_reset_complete(porttype, port):
+                    return 'OK'
+            if time.monotonic() <= deadline:
+                return None
+            result = 'reset timed out'
+        except (PhyException, SfpHelperException) as e:
+            result = str(e)
+        self.sfphelper.invalidate_phy(porttype, port)
+        return result
+
+    def _wait_phy_reset(self, porttype, port):
+        '''
+        Wait for the PHY reset started on the given port by a change
+        made with wait=False, returning 'OK' or the error. Called with
+        phy_access held for the port, but helper_access is only held
+        while polling so that other ports can be used meanwhile.
+        '''
+        deadline = time.monotonic() + PhyResetTracker.RESET_TIMEOUT
+        while True:
+            time.sleep(PhyResetTracker.POLL_INTERVAL)
+            result = self.poll_phy_reset(porttype, port, deadline)
+            if result is not None:
+                return result
+
+    def _update_phy_link_status(self, portname, sfp_state,
+                                changes_only=False):
+        '''
+        Read the PHY link status of a port, remembering it and
+        publishing it on the phylink topic if it has changed
+
+        If changes_only is set and the PHY can tell that the link
+        status hasn't changed since it was last remembered, then the
+        status isn't read.
+
+        Returns None, leaving the status as it was, if the PHY
+        couldn't be read.
+        '''
+        porttype = sfp_state.state['type']
+        port = sfp_state.state['port']
+        try:
+            with self.phy_access(porttype, port), self.helper_access():
+                if changes_only and portname in self.phy_link_state:
+                    status = self.sfphelper.get_phy_link_change(porttype,
+                                                                port)
+                else:
+                    status = self.sfphelper.read_phy_link_status(porttype,
+                                                                 port)
+        except (PhyException, SfpHelperException) as e:
+            dbg("Failed to read PHY link status of {}: {}".format(
+                portname, e))
+            return None
+        with self.phy_link_lock:
+            if self.sfp_state.get(portname) is not sfp_state:
+                # Removed or replaced while being read
+                return status
+            if status is None:
+                return self.phy_link_state.get(portname)
+            # A newly inserted module starts off with the link down
+            previous = self.phy_link_state.get(portname,
+                                               ("down", 0, "unknown"))
+            self.phy_link_state[portname] = status
+            if status != previous:
+                self.run_on_main(partial(self.publish_phy_link_event,
+                                         portname, status))
+        return status
+
+    def run_phy_link_monitor(self):
+        '''
+        Read the PHY link status of all present ports
+        '''
+        if not self.sfphelper:
+            return
+        for portname, sfp_state in list(self.sfp_state.items()):
+            self._update_phy_link_status(portname, sfp_state,
+                                         changes_only=True)
+
+    def publish_phy_link_event(self, portname, status):
+        '''
+        Publish a change in the PHY link status of a port on the
+        phylink topic
+        '''
+        topic = "phylink"
+
+        (link, speed, duplex) = status
+        event = {
+            'ports': {
+                portname: {
+                    'link': link,
+                    'speed': speed,
+                    'duplex': duplex,
+                }
+            }
+        }
+        self.pub_socket.send_string(topic + ' ' + json.dumps(event))
+
+    def phy_link_monitor_running(self):
+        return self.phy_link_monitor is not None and \
+            self.phy_link_monitor.is_alive() and \
+            not self.phy_link_monitor.stopped.is_set()
+
+    def update_phy_link_interval(self, interval):
+        '''
+        Set the PHY link monitoring interval, stopping the monitor if
+        it is 0
+        '''
+        dbg("Setting PHY link monitoring interval to {}s".format(interval))
+
+        if not self.phy_link_monitor_running():
+            if int(interval) == 0:
+                return
+            dbg("Starting PhyLinkMonitor thread")
+            self.phy_link_monitor = PhyLinkMonitor(self)
+            self.phy_link_monitor.setInterval(interval)
+            self.phy_link_monitor.start()
+            # Read the status straight away
+            self.phy_link_monitor.trigger()
+            return
+
+        self.phy_link_monitor.setInterval(interval)
+        if int(interval) == 0:
+            # No longer kept up to date
+            with self.phy_link_lock:
+                self.phy_link_state.clear()
+
+    def _process_phylinkmonitorinterval_command(self, json):
+        '''
+        Process the PHY link monitor interval command
+
+        This command sets the interval at which the PHY link status of
+        present ports is polled, or stops polling if it is 0.
+        '''
+        self.update_phy_link_interval(json['value'])
+        return { 'result': 'OK' }
+
+    def publish_phy_config_event(self, portname, operation, result):
+        '''
+        Publish the outcome of an asynchronous PHY configuration
+        command on the phyconfig topic
+        '''
+        topic = "phyconfig"
+
+        event = {
+            'ports': {
+                portname: {
+                    'operation': operation,
+                    'result': result,
+                }
+            }
+        }
+        self.pub_socket.send_string(topic + ' ' + json.dumps(event))
 
     def _process_sfpstateset_command(self, json):
         portname = json['portname']
         enabled = json['enabled']
 
+        # The helper may change the PHY of a module that is present
+        sfp_state = self.sfp_state.get(portname)
+        if sfp_state is not None:
+            phy_access = self.phy_access(sfp_state.state['type'],
+                                         sfp_state.state['port'])
+        else:
+            phy_access = nullcontext()
         try:
-            self.sfphelper.set_sfp_state(portname, enabled)
+            with phy_access, self.helper_access():
+                self.sfphelper.set_sfp_state(portname, enabled)
         except ModuleNotPresentException:
             # The module not being present is fine. The client is
             # expected to replay the SFP state set command when a
             # module is inserted, since this is needed for vyatta-sfpd
             # restart support anyway.
             pass
-        self.rep_socket.send_json({ 'result': 'OK' })
+        return { 'result': 'OK' }
 
     def _process_sfpreadeeprom_command(self, json):
         portname = json['portname']
@@ -307,31 +956,53 @@ class SfpStateManager(object):
             length = int(json['length'])
 
         if not portname in self.sfp_state:
-            self.rep_socket.send_json({ 'result': 'SFP not present'})
-            return
+            return { 'result': 'SFP not present'}
 
         sfp_state = self.sfp_state[portname]
         porttype = sfp_state.state['type']
         port = sfp_state.state['port']
 
-        data = self.sfphelper.read_eeprom(porttype, port, offset, length)
-        self.rep_socket.send_json({ 'result': 'OK',
-                                    'data': base64.b64encode(data).decode() })
+        with self.helper_access():
+            data = self.read_eeprom(porttype, port, offset, length)
+        if json.get('encoding') == 'binary':
+            return ({ 'result': 'OK', 'length': len(data) }, data)
+        return { 'result': 'OK',
+                 'data': base64.b64encode(data).decode() }
+
+    def _process_capabilities_command(self, json):
+        '''
+        Process a request for the protocol version and capabilities
+
+        The protocol version used is the lower of the client's and
+        ours, with clients that don't say assumed to use version 1.
+        '''
+        protocol = min(int(json.get('protocol', 1)), self.PROTOCOL_VERSION)
+        capabilities = self.CAPABILITIES if protocol >= 2 else []
+        return { 'result': 'OK',
+                 'protocol': protocol,
+                 'capabilities': capabilities }
+
+    def _process_stats_command(self):
+        '''
+        Process a request for sfpd statistics, such as the timing of
+        the boot walk
+        '''
+        return { 'result': 'OK', 'stats': self.stats }
 
     def _process_sfpqueryeeprom_command(self, json):
         portname = json['portname']
         if not portname in self.sfp_state:
-            self.rep_socket.send_json({ 'result': 'SFP not present'})
-            return
+            return { 'result': 'SFP not present'}
 
         sfp_state = self.sfp_state[portname]
         porttype = sfp_state.state['type']
         port = sfp_state.state['port']
 
-        pages = self.sfphelper.query_eeprom(porttype, port)
-        self.rep_socket.send_json({ 'result': 'OK',
-                                    'porttype': porttype,
-                                    'pages': pages })
+        with self.helper_access():
+            pages = self.sfphelper.query_eeprom(porttype, port)
+        return { 'result': 'OK',
+                 'porttype': porttype,
+                 'pages': pages }
 
     def _process_sfpinsertedremoved_command(self, json):
         """ Process the message that says an sfp has been plugged/unplugged
@@ -355,20 +1026,30 @@ class SfpStateManager(object):
         # If the SFP helper supports a method processing this then
         # call it, otherwise use the default on_sfp_presence_change
         # action here, which is sufficient for testing purposes
-        self.sfphelper.process_sfpinsertedremoved(
-            portname, porttype, int(portid), inserted, extra_state)
-        self.rep_socket.send_json({ 'result': 'OK' })
+        with self.helper_access():
+            self.sfphelper.process_sfpinsertedremoved(
+                portname, porttype, int(portid), inserted, extra_state)
+        return { 'result': 'OK' }
 
-    def build_monitor_msg(self, data):
+    def build_monitor_msg(self, data, changed_only=False):
         '''
         Returns monitoring protobuf message with EEPROM data.
+
+        If changed_only is set then ports whose EEPROM data is the
+        same as when last published are left out.
         '''
         cfg = SFPMonitor_pb2.SFPStatusList()
+        published = {}
         for porttype in data:
             for port in data[porttype]['eeprom']:
                 eeprom_data = data[porttype]['eeprom'][port]
                 if eeprom_data is None:
                     continue
+                key = (porttype, port)
+                published[key] = eeprom_data
+                if changed_only and \
+                   self._monitor_published.get(key) == eeprom_data:
+                    continue
                 current_sfp = cfg.sfp.add()
                 current_sfp.name = port
                 current_sfp.type = porttype
@@ -377,20 +1058,73 @@ class SfpStateManager(object):
                 current_eeprom.length = data[porttype]['length']
                 current_eeprom.data = eeprom_data
 
+        # Ports no longer being reported are forgotten, so that they
+        # are published again if they come back
+        self._monitor_published = published
         return cfg
 
-    def _sfp_monitor_timer_handler(self):
+    def helper_access(self):
         '''
-        Retrieves data from SFP EEPROMs and sends to dataplane.
+        Returns a context manager to hold while using the SFP helper
+        from a thread other than the main one, or from the main one
+        while the monitoring worker may be running.
         '''
-        self.rep_socket.send_json({ 'result': 'OK' })
-        if self.sfpd_monitor_callback is not None:
-            data = self.sfpd_monitor_callback()
+        return self.io_lock
 
-        monitor_msg = self.build_monitor_msg(data)
-        self.monitor_socket.send_string('SFPDSTATUS_NOTIFY')
-        self.monitor_socket.send_multipart([b'SFPDSTATUS_MSG',
-                                            monitor_msg.SerializeToString()])
+    def phy_access(self, porttype, port):
+        '''
+        Returns a context manager to hold while accessing the PHY on
+        the given port, from any thread. Taken before helper_access.
+        '''
+        with self._phy_locks_lock:
+            return self._phy_locks.setdefault((porttype, port), RLock())
+
+    def send_monitor_notify(self, notification):
+        '''
+        Send a notification string on the monitor socket
+        '''
+        with self.monitor_lock:
+            self.monitor_socket.send_string(notification)
+
+    def _process_sfpmonitortrigger_command(self):
+        '''
+        Process a request to run SFP monitoring now
+        '''
+        if self.timer is not None and self.timer.is_alive():
+            self.timer.trigger()
+        else:
+            Thread(target=self.run_sfp_monitor, daemon=True).start()
+        return { 'result': 'OK' }
+
+    def run_sfp_monitor(self):
+        '''
+        Retrieves data from SFP EEPROMs and sends to dataplane.
+
+        Called from the monitoring worker.
+        '''
+        if self.sfpd_monitor_callback is None:
+            return
+        data = self.sfpd_monitor_callback()
+
+        self._monitor_ticks += 1
+        if self._monitor_ticks >= self.monitor_full_refresh:
+            self._monitor_full_pending = True
+        delta = self.monitor_delta and not self._monitor_full_pending
+        if not delta:
+            self._monitor_ticks = 0
+            self._monitor_full_pending = False
+
+        monitor_msg = self.build_monitor_msg(data, changed_only=delta)
+        if delta:
+            if len(monitor_msg.sfp) == 0:
+                return
+            msg_type = b'SFPDSTATUS_DELTA_MSG'
+        else:
+            msg_type = b'SFPDSTATUS_MSG'
+        with self.monitor_lock:
+            self.monitor_socket.send_string('SFPDSTATUS_NOTIFY')
+            self.monitor_socket.send_multipart([msg_type,
+                                                monitor_msg.SerializeToString()])
 
     def update_monitoring_interval(self, interval):
         dbg("Setting monitoring interval to {}s".format(interval))
@@ -412,49 +1146,179 @@ class SfpStateManager(object):
         '''
         interval = json['value']
         self.update_monitoring_interval(interval)
-        self.rep_socket.send_json({ 'result': 'OK' })
+        return { 'result': 'OK' }
+
+    def _process_sfpmonitormode_command(self, json):
+        '''
+        Process the monitor mode command
+
+        This command selects whether each monitoring tick publishes the
+        status of all SFPs as an SFPDSTATUS_MSG, or only those whose
+        status changed as an SFPDSTATUS_DELTA_MSG with a full
+        SFPDSTATUS_MSG every full_refresh ticks.
+        '''
+        self.monitor_delta = bool(json['delta'])
+        if 'full_refresh' in json:
+            full_refresh = int(json['full_refresh'])
+            if full_refresh < 1:
+                return { 'result': 'invalid full_refresh {}'.format(full_refresh) }
+            self.monitor_full_refresh = full_refresh
+        self._monitor_full_pending = True
+        return { 'result': 'OK' }
+
+    def _process_sfpmonitorrefresh_command(self):
+        '''
+        Process the monitor refresh command
+
+        This command requests that the status of all SFPs be published
+        on the next monitoring tick, even in delta mode.
+        '''
+        self._monitor_full_pending = True
+        return { 'result': 'OK' }
 
     def process_rep_socket(self):
         '''
-        Process a message becoming available on the REP socket
+        Process messages becoming available on the ROUTER socket
+
+        Each request arrives as the client's envelope of routing
+        frames, terminated by an empty delimiter frame, followed by
+        the JSON request. The reply is sent back with the same
+        envelope, which is what REQ clients expect. Long running
+        commands are processed by command workers, so that other
+        clients' requests can be processed in the meantime.
         '''
         eventProcessed = False
         while self.rep_socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            frames = self.rep_socket.recv_multipart()
             try:
-                json = self.rep_socket.recv_json()
-                if json is None or not "command" in json:
-                    self.rep_socket.send_json({ 'result': 'bad command' })
-                    continue
-                command = json["command"]
-                if command == 'REPLAY':
-                    self._process_replay_command()
-                elif command == 'PHYLINKSTATUS':
-                    self._process_phylinkstatus_command()
-                elif command == 'PHYSPEEDDUPLEXSET':
-                    self._process_physpeedduplexset_command(json)
-                elif command == 'PHYAUTONEGSET':
-                    self._process_phyautonegset_command(json)
-                elif command == 'SFPSTATESET':
-                    self._process_sfpstateset_command(json)
-                elif command == 'SFPREADEEPROM':
-                    self._process_sfpreadeeprom_command(json)
-                elif command == 'SFPQUERYEEPROM':
-                    self._process_sfpqueryeeprom_command(json)
-                elif command == 'SFPINSERTEDREMOVED':
-                    self._process_sfpinsertedremoved_command(json)
-                elif command == 'SFPMONITORINTERVAL':
-                    self._process_sfpmonitorinterval_command(json)
-                elif command == 'SFPMONITORTRIGGER':
-                    self._sfp_monitor_timer_handler()
-                else:
-                    self.rep_socket.send_json(
-                        { 'result': 'unrecognised command {}'.format(command) })
-                    continue
-                eventProcessed = True
-            except Exception as e:
-                self.rep_socket.send_json({ 'result': str(e) })
+                delimiter = frames.index(b'')
+            except ValueError:
+                # Not a request that can be replied to
+                continue
+            envelope = frames[:delimiter + 1]
+            try:
+                req = json.loads(frames[delimiter + 1])
+            except (IndexError, ValueError):
+                req = None
+            if not isinstance(req, dict) or not "command" in req:
+                self._send_reply(envelope, { 'result': 'bad command' })
+                continue
+            if req["command"] in self.WORKER_COMMANDS:
+                self._command_executor.submit(self._run_worker_command,
+                                              envelope, req)
+            else:
+                self._send_reply(envelope, self._run_command(req))
+            eventProcessed = True
         return eventProcessed
 
+    def _send_reply(self, envelope, reply):
+        '''
+        Send a reply to the client with the given envelope
+
+        The reply is either a dictionary, which is sent as a single
+        JSON frame, bytes that are already encoded JSON, or a tuple of
+        a dictionary and bytes, which are sent as a JSON header frame
+        followed by a frame of the bytes.
+        '''
+        if isinstance(reply, tuple):
+            (header, payload) = reply
+            frames = [json.dumps(header).encode(), payload]
+        elif isinstance(reply, bytes):
+            frames = [reply]
+        else:
+            frames = [json.dumps(reply).encode()]
+        self.rep_socket.send_multipart(envelope + frames)
+
+    def _run_command(self, json):
+        '''
+        Process a command, returning the reply to send
+        '''
+        try:
+            return self._dispatch_command(json)
+        except Exception as e:
+            return { 'result': str(e) }
+
+    def _run_worker_command(self, envelope, json):
+        '''
+        Process a command in a command worker and arrange for the
+        reply to be sent from the main thread
+        '''
+        reply = self._run_command(json)
+        self.run_on_main(lambda: self._send_reply(envelope, reply))
+
+    def _dispatch_command(self, json):
+        '''
+        Process a command, returning the reply to send
+        '''
+        command = json["command"]
+        if command == 'REPLAY':
+            return self._process_replay_command(json)
+        elif command == 'PHYLINKSTATUS':
+            return self._process_phylinkstatus_command(json)
+        elif command == 'PHYSPEEDDUPLEXSET':
+            return self._process_physpeedduplexset_command(json)
+        elif command == 'PHYAUTONEGSET':
+            return self._process_phyautonegset_command(json)
+        elif command == 'SFPSTATESET':
+            return self._process_sfpstateset_command(json)
+        elif command == 'SFPREADEEPROM':
+            return self._process_sfpreadeeprom_command(json)
+        elif command == 'SFPQUERYEEPROM':
+            return self._process_sfpqueryeeprom_command(json)
+        elif command == 'SFPINSERTEDREMOVED':
+            return self._process_sfpinsertedremoved_command(json)
+        elif command == 'SFPMONITORINTERVAL':
+            return self._process_sfpmonitorinterval_command(json)
+        elif command == 'SFPMONITORMODE':
+            return self._process_sfpmonitormode_command(json)
+        elif command == 'SFPMONITORREFRESH':
+            return self._process_sfpmonitorrefresh_command()
+        elif command == 'PHYLINKMONITORINTERVAL':
+            return self._process_phylinkmonitorinterval_command(json)
+        elif command == 'SFPMONITORTRIGGER':
+            return self._process_sfpmonitortrigger_command()
+        elif command == 'CAPABILITIES':
+            return self._process_capabilities_command(json)
+        elif command == 'STATS':
+            return self._process_stats_command()
+        return { 'result': 'unrecognised command {}'.format(command) }
+
+    def run_on_main(self, func):
+        '''
+        Arrange for func to be called from the main thread
+
+        May be called from any thread.
+        '''
+        self._main_calls.put(func)
+        os.write(self._main_calls_wfd, b'\0')
+
+    def process_main_calls(self):
+        '''
+        Make the calls queued by run_on_main. Called from the main
+        thread when the main calls fd becomes readable.
+        '''
+        try:
+            while os.read(self._main_calls_rfd, 512):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                func = self._main_calls.get_nowait()
+            except queue.Empty:
+                break
+            func()
+        # The ROUTER socket's fd is edge triggered, so requests that
+        # arrived while sending replies above wouldn't wake us up
+        self.process_rep_socket()
+
+    def get_main_calls_fd(self):
+        '''
+        Get the fd that becomes readable when there are calls queued
+        for the main thread
+        '''
+        return self._main_calls_rfd
+
     def get_rep_socket_fd(self):
         '''
         Get the REP socket
@@ -0,0 +1,348 @@
+# Copyright (c) 2021, AT&T Intellectual Property.  All rights reserved.
+#
+# SPDX-License-Identifier: LGPL-2.1-only
+
+"""
+Fixed-record SFP presence table
+
+The table is a file with a header followed by one fixed size record
+per port, so that a reader can mmap it and look a port up without
+parsing anything. The slot of a port is its port number for SFPs and
+its port number plus 128 for QSFPs, as for the sections of the INI
+presence file.
+
+All integers are little endian. The header is:
+
+  0  4s  magic, b'SFPP'
+  4  H   version
+  6  H   record size
+  8  Q   generation
+  16 H   number of records
+  18 H   reserved
+  20 I   sfpd epoch
+  24 I   boot scan end time, in seconds since boot
+  28 I   reserved
+
+The generation is odd while the table is being updated and is
+incremented again once the update is complete. A reader copies what
+it needs and then checks that the generation is even and unchanged,
+otherwise it tries again. A reader can also tell whether anything has
+changed since it last looked by comparing generations. A table that
+has to be recreated, for example because sfpd died in the middle of an
+update, is reinitialised in place, so that readers that already have
+it mapped see the new contents.
+
+Each record is:
+
+  0  B   flags, PRESENT and HAS_DIAG
+  1  B   port type, PORTTYPE_SFP or PORTTYPE_QSFP
+  2  H   port number
+  4  I   sfpd epoch in which the module was detected
+  8  I   detection time, in seconds since boot
+  12 16s port name
+  28 16s vendor name
+  44 8s  vendor OUI
+  52 16s part ID
+  68 4s  vendor revision
+
+Strings are UTF-8, padded with NULs and not necessarily terminated.
+Strings longer than their field are truncated at a character boundary,
+so port names are limited to 16 bytes, vendor names and part IDs to 16,
+vendor OUIs to 8 and vendor revisions to 4.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+PRESENCE_TABLE_FILE = '/var/run/vyatta/sfpd-presence.tbl'
+
+MAGIC = b'SFPP'
+VERSION = 1
+NUM_RECORDS = 256
+QSFP_SLOT_OFFSET = 128
+
+HEADER = struct.Struct('<4sHHQHHIII')
+RECORD = struct.Struct('<BBHII16s16s8s16s4s')
+GENERATION = struct.Struct('<Q')
+GENERATION_OFFSET = 8
+EPOCH = struct.Struct('<II')
+EPOCH_OFFSET = 20
+
+PRESENT = 1 << 0
+HAS_DIAG = 1 << 1
+
+PORTTYPE_SFP = 1
+PORTTYPE_QSFP = 2
+PORTTYPES = {
+    'SFP': PORTTYPE_SFP,
+    'QSFP': PORTTYPE_QSFP,
+}
+
+TABLE_SIZE = HEADER.size + NUM_RECORDS * RECORD.size
+
+class SfpPresenceTableError(Exception):
+    pass
+
+def port_slot(porttype, port):
+    '''
+    Get the slot of the record for a port
+    '''
+    if port < 0 or port >= QSFP_SLOT_OFFSET or porttype not in PORTTYPES:
+        raise SfpPresenceTableError(
+            "no slot for {} {}".format(porttype, port))
+    if porttype == 'QSFP':
+        return port + QSFP_SLOT_OFFSET
+    return port
+
+def _record_offset(slot):
+    return HEADER.size + slot * RECORD.size
+
+def _encode_str(value, size):
+    encoded = value.encode('utf-8')
+    if len(encoded) <= size:
+        return encoded
+    # Drop any character cut in half
+    return encoded[:size].decode('utf-8', 'ignore').encode('utf-8')
+
+def _decode_str(value):
+    return value.rstrip(b'\0').decode('utf-8', 'replace')
+
+def _decode_record(record):
+    (flags, porttype, port, epoch, detection_time, port_name,
+     vendor_name, vendor_oui, part_id, vendor_rev) = RECORD.unpack(record)
+    if not flags & PRESENT:
+        return None
+    if porttype == PORTTYPE_QSFP:
+        port_type = 'QSFP'
+    else:
+        port_type = 'SFP'
+    # The same form as the port entries of the sfpd presence dict
+    return {
+        'port': port,
+        'port_type': port_type,
+        'port_name': _decode_str(port_name),
+        'vendor_name': _decode_str(vendor_name),
+        'vendor_oui': _decode_str(vendor_oui),
+        'vendor_part_id': _decode_str(part_id),
+        'vendor_rev': _decode_str(vendor_rev),
+        'time': str(detection_time),
+        'epoch': epoch,
+        'has_diag': bool(flags & HAS_DIAG),
+    }
+
+class SfpPresenceTable(object):
+    '''
+    The presence table as maintained by sfpd
+
+    There must only be one writer of the table at a time.
+    '''
+    def __init__(self, path=PRESENCE_TABLE_FILE):
+        self.path = path
+        # Whether the table was created rather than being left by a
+        # previous sfpd
+        self.created = not self._is_valid()
+        if self.created:
+            self._create()
+        self._fd = os.open(path, os.O_RDWR)
+        self._map = mmap.mmap(self._fd, TABLE_SIZE)
+
+    def _is_valid(self):
+        '''
+        Is there a table left by a previous sfpd that can be reused?
+        '''
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(HEADER.size)
+                size = os.fstat(f.fileno()).st_size
+        except OSError:
+            return False
+        if len(header) < HEADER.size or size != TABLE_SIZE:
+            return False
+        (magic, version, record_size, generation, num_records,
+         _, _, _, _) = HEADER.unpack(header)
+        return magic == MAGIC and version == VERSION and \
+            record_size == RECORD.size and num_records == NUM_RECORDS and \
+            generation % 2 == 0
+
+    def _create(self):
+        '''
+        Initialise an empty table, in place rather than replacing the
+        file, since readers may have the existing file mapped
+
+        The generation carries on from any existing table, so that
+        readers comparing generations see that it has changed.
+        '''
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.fchmod(fd, 0o644)
+            generation = 0
+            header = os.pread(fd, HEADER.size, 0)
+            if len(header) == HEADER.size and header[:len(MAGIC)] == MAGIC:
+                (generation,) = GENERATION.unpack_from(header,
+                                                       GENERATION_OFFSET)
+            # Odd while being initialised
+            generation += 1 if generation % 2 == 0 else 2
+            os.ftruncate(fd, TABLE_SIZE)
+            os.pwrite(fd, GENERATION.pack(generation), GENERATION_OFFSET)
+            os.pwrite(fd, bytes(NUM_RECORDS * RECORD.size), HEADER.size)
+            os.pwrite(fd, HEADER.pack(MAGIC, VERSION, RECORD.size,
+                                      generation, NUM_RECORDS, 0, 0, 0, 0), 0)
+            os.pwrite(fd, GENERATION.pack(generation + 1), GENERATION_OFFSET)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _begin_update(self):
+        (generation,) = GENERATION.unpack_from(self._map, GENERATION_OFFSET)
+        GENERATION.pack_into(self._map, GENERATION_OFFSET, generation + 1)
+        return generation + 1
+
+    def _end_update(self, generation):
+        GENERATION.pack_into(self._map, GENERATION_OFFSET, generation + 1)
+
+    def generation(self):
+        (generation,) = GENERATION.unpack_from(self._map, GENERATION_OFFSET)
+        return generation
+
+    def get_epoch(self):
+        '''
+        Get the sfpd epoch and boot scan end time recorded in the table
+        '''
+        return EPOCH.unpack_from(self._map, EPOCH_OFFSET)
+
+    def set_epoch(self, epoch, boot_scan_end_time):
+        generation = self._begin_update()
+        EPOCH.pack_into(self._map, EPOCH_OFFSET, epoch,
+                        int(boot_scan_end_time))
+        self._end_update(generation)
+
+    def update(self, pinfo):
+        '''
+        Write the record of a present port, given its entry in the
+        sfpd presence dict
+        '''
+        flags = PRESENT
+        if pinfo.get('has_diag', False):
+            flags |= HAS_DIAG
+        slot = port_slot(pinfo['port_type'], pinfo['port'])
+        record = RECORD.pack(flags, PORTTYPES[pinfo['port_type']],
+                             pinfo['port'], pinfo['epoch'],
+                             int(pinfo.get('time', 0)),
+                             _encode_str(pinfo['port_name'], 16),
+                             _encode_str(pinfo['vendor_name'], 16),
+                             _encode_str(pinfo['vendor_oui'], 8),
+                             _encode_str(pinfo['vendor_part_id'], 16),
+                             _encode_str(pinfo['vendor_rev'], 4))
+        generation = self._begin_update()
+        offset = _record_offset(slot)
+        self._map[offset:offset + RECORD.size] = record
+        self._end_update(generation)
+
+    def clear(self, porttype, port):
+        '''
+        Clear the record of a port that is no longer present
+        '''
+        offset = _record_offset(port_slot(porttype, port))
+        generation = self._begin_update()
+        self._map[offset:offset + RECORD.size] = bytes(RECORD.size)
+        self._end_update(generation)
+
+    def records(self):
+        '''
+        Get the entries of all present ports
+        '''
+        entries = []
+        for slot in range(NUM_RECORDS):
+            offset = _record_offset(slot)
+            entry = _decode_record(self._map[offset:offset + RECORD.size])
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+class SfpPresenceTableReader(object):
+    '''
+    Read-only view of the presence table, safe against concurrent
+    updates by sfpd
+    '''
+
+    # How long to wait for an update in progress to complete before
+    # giving up, since sfpd may have died in the middle of it
+    UPDATE_TIMEOUT = 1.0
+    RETRY_INTERVAL = 0.001
+
+    def __init__(self, path=PRESENCE_TABLE_FILE):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < TABLE_SIZE:
+                raise SfpPresenceTableError("not an sfpd presence table")
+            self._map = mmap.mmap(f.fileno(), TABLE_SIZE,
+                                  access=mmap.ACCESS_READ)
+        if HEADER.unpack_from(self._map)[0] != MAGIC:
+            self._map.close()
+            raise SfpPresenceTableError("not an sfpd presence table")
+
+    def close(self):
+        self._map.close()
+
+    def generation(self):
+        '''
+        Get the generation of the table, which changes whenever
+        anything in it changes
+
+        Raises SfpPresenceTableError if an update doesn't complete
+        within UPDATE_TIMEOUT.
+        '''
+        deadline = None
+        while True:
+            (generation,) = GENERATION.unpack_from(self._map,
+                                                   GENERATION_OFFSET)
+            if generation % 2 == 0:
+                return generation
+            if deadline is None:
+                deadline = time.monotonic() + self.UPDATE_TIMEOUT
+            elif time.monotonic() > deadline:
+                raise SfpPresenceTableError(
+                    "presence table update didn't complete")
+            time.sleep(self.RETRY_INTERVAL)
+
+    def _read(self, offset, length):
+        while True:
+            generation = self.generation()
+            data = self._map[offset:offset + length]
+            (after,) = GENERATION.unpack_from(self._map, GENERATION_OFFSET)
+            if after == generation:
+                return (data, generation)
+
+    def get_epoch(self):
+        '''
+        Get the sfpd epoch and boot scan end time
+        '''
+        (data, _) = self._read(EPOCH_OFFSET, EPOCH.size)
+        return EPOCH.unpack(data)
+
+    def lookup(self, porttype, port):
+        '''
+        Get the entry of a port, or None if it isn't present
+        '''
+        (data, _) = self._read(_record_offset(port_slot(porttype, port)),
+                               RECORD.size)
+        return _decode_record(data)
+
+    def records(self):
+        '''
+        Get the entries of all present ports and the generation they
+        are consistent with
+        '''
+        (data, generation) = self._read(HEADER.size,
+                                        NUM_RECORDS * RECORD.size)
+        entries = []
+        for slot in range(NUM_RECORDS):
+            entry = _decode_record(data[slot * RECORD.size:
+                                        (slot + 1) * RECORD.size])
+            if entry is not None:
+                entries.append(entry)
+        return (entries, generation)
@@ -0,0 +1,10 @@
+# Copyright (c) 2021, AT&T Intellectual Property.  All rights reserved.
+#
+# SPDX-License-Identifier: LGPL-2.1-only
+
+import os
+import sys
+
+# Test the modules in the tree rather than any installed ones
+LIB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib')
+sys.path.insert(0, LIB_DIR)
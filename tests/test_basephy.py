@@ -0,0 +1,138 @@
+# Copyright (c) 2021, AT&T Intellectual Property.  All rights reserved.
+#
+# SPDX-License-Identifier: LGPL-2.1-only
+
+import socket
+import unittest
+from unittest import mock
+from vyatta.phy.basephy import BasePhy, PhyTransaction, PhyAccessException
+from vyatta.phy.marvell88e1111 import Marvell88E1111Phy
+
+class FakeBus(object):
+    '''
+    PHY registers behind a bus, with values in bus byte order, that
+    records the operations made on it
+    '''
+    def __init__(self, regs=None):
+        self.regs = dict(regs or {})
+        self.ops = []
+
+    def read_word_data(self, addr, reg):
+        self.ops.append((BasePhy.OP_READ, reg))
+        return socket.htons(self.regs.get(reg, 0))
+
+    def write_word_data(self, addr, reg, data):
+        self.ops.append((BasePhy.OP_WRITE, reg))
+        # The reset bit clears itself straight away
+        self.regs[reg] = socket.ntohs(data) & ~BasePhy.CTRL_RESET
+
+class StuckResetBus(FakeBus):
+    '''
+    A bus to a PHY whose reset never completes
+    '''
+    def write_word_data(self, addr, reg, data):
+        self.ops.append((BasePhy.OP_WRITE, reg))
+        self.regs[reg] = socket.ntohs(data)
+
+class TestPhyTransaction(unittest.TestCase):
+    def test_merges_changes_to_the_same_register(self):
+        txn = PhyTransaction(None, None)
+        txn.modify(0x04, 0x00f0, 0x0030)
+        txn.modify(0x04, 0x0030, 0x0010)
+        txn.modify(0x09, 0x0300, 0x0200)
+        self.assertEqual(txn.changes, {
+            0x04: (0x00f0, 0x0010),
+            0x09: (0x0300, 0x0200),
+        })
+
+    def test_keeps_registers_in_the_order_first_modified(self):
+        txn = PhyTransaction(None, None)
+        txn.modify(0x09, 0x1, 0x1)
+        txn.modify(0x00, 0x2, 0x2)
+        txn.modify(0x09, 0x4, 0x4)
+        self.assertEqual(list(txn.changes), [0x09, 0x00])
+
+    def test_commit_resets_once_after_the_other_changes(self):
+        phy = Marvell88E1111Phy()
+        bus = FakeBus({0x00: 0x1140, 0x04: 0x0de1, 0x09: 0x0300})
+        phy.set_speed_duplex(bus, 100, 'full')
+        writes = [reg for (op, reg) in bus.ops if op == BasePhy.OP_WRITE]
+        self.assertEqual(writes, [0x00])
+        self.assertEqual(bus.regs[0x00], 0x2100)
+
+        bus = FakeBus({0x00: 0x2100})
+        phy = Marvell88E1111Phy()
+        phy.set_autoneg_caps(bus, BasePhy.ALL_AUTONEG_CAPS)
+        writes = [reg for (op, reg) in bus.ops if op == BasePhy.OP_WRITE]
+        self.assertEqual(writes, [0x04, 0x09, 0x00])
+        self.assertEqual(bus.regs[0x00] & Marvell88E1111Phy.CTRL_AN_ENABLE,
+                         Marvell88E1111Phy.CTRL_AN_ENABLE)
+
+    def test_commit_without_waiting_leaves_reset_to_be_polled(self):
+        phy = Marvell88E1111Phy()
+        bus = FakeBus()
+        txn = phy.transaction(bus)
+        txn.modify(0x04, 0x0060, 0x0060)
+        txn.commit(wait=False)
+        self.assertEqual(txn.changes, {})
+        # Nothing done after the write starting the reset
+        ctrl_write = bus.ops.index((BasePhy.OP_WRITE, 0x00))
+        self.assertEqual(bus.ops[ctrl_write + 1:], [])
+        self.assertTrue(phy.reset_complete(bus))
+
+    @mock.patch('vyatta.phy.basephy.sleep')
+    def test_commit_raises_when_reset_times_out(self, sleep):
+        phy = Marvell88E1111Phy()
+        bus = StuckResetBus()
+        with self.assertRaises(PhyAccessException):
+            phy.set_speed_duplex(bus, 100, 'full')
+        self.assertFalse(phy.reset_complete(bus))
+
+class FailingBus(FakeBus):
+    def write_word_data(self, addr, reg, data):
+        raise OSError("bus error")
+
+class TestRegisterShadow(unittest.TestCase):
+    def test_shadowed_register_is_written_without_reading(self):
+        phy = Marvell88E1111Phy()
+        bus = FakeBus({0x04: 0x0de1})
+        phy._phy_modify_reg(bus, 0x04, 0x0060, 0x0020)
+        self.assertEqual(bus.ops, [(BasePhy.OP_READ, 0x04),
+                                   (BasePhy.OP_WRITE, 0x04)])
+        bus.ops = []
+        phy._phy_modify_reg(bus, 0x04, 0x0001, 0x0000)
+        self.assertEqual(bus.ops, [(BasePhy.OP_WRITE, 0x04)])
+        self.assertEqual(bus.regs[0x04], 0x0da0)
+
+    def test_shadow_merges_in_host_byte_order(self):
+        phy = Marvell88E1111Phy()
+        bus = FakeBus({0x09: 0x0300})
+        phy._phy_modify_reg(bus, 0x09, 0x0100, 0x0000)
+        phy._phy_modify_reg(bus, 0x09, 0x0001, 0x0001)
+        self.assertEqual(bus.regs[0x09], 0x0201)
+        self.assertEqual(phy._shadow[0x09], 0x0201)
+
+    def test_reset_bit_isnt_shadowed(self):
+        phy = Marvell88E1111Phy()
+        bus = FakeBus({0x00: 0x1140})
+        phy._phy_modify_reg(bus, 0x00, 0, BasePhy.CTRL_RESET)
+        self.assertEqual(phy._shadow[0x00], 0x1140)
+
+    def test_unshadowed_register_is_always_read(self):
+        phy = Marvell88E1111Phy()
+        bus = FakeBus()
+        phy._phy_modify_reg(bus, 0x12, 0x1, 0x1)
+        phy._phy_modify_reg(bus, 0x12, 0x2, 0x2)
+        self.assertNotIn(0x12, phy._shadow)
+        self.assertEqual(bus.ops.count((BasePhy.OP_READ, 0x12)), 2)
+
+    def test_bus_error_invalidates_shadow(self):
+        phy = Marvell88E1111Phy()
+        phy._phy_modify_reg(FakeBus(), 0x04, 0x1, 0x1)
+        self.assertIn(0x04, phy._shadow)
+        with self.assertRaises(OSError):
+            phy._phy_modify_reg(FailingBus(), 0x04, 0x2, 0x2)
+        self.assertEqual(phy._shadow, {})
+
+if __name__ == '__main__':
+    unittest.main()
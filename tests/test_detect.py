@@ -0,0 +1,129 @@
+# Copyright (c) 2021, AT&T Intellectual Property.  All rights reserved.
+#
+# SPDX-License-Identifier: LGPL-2.1-only
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from vyatta.platform import detect
+
+BOOT_ID = '6b0f0ac4-54a3-4ea8-bc36-7b6a6e0bb2c1'
+
+class TestDetectCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved_cache_file = detect.DETECT_CACHE_FILE
+        detect.DETECT_CACHE_FILE = os.path.join(self.dir, 'run',
+                                                'platform-detect.json')
+
+    def tearDown(self):
+        detect.DETECT_CACHE_FILE = self.saved_cache_file
+        shutil.rmtree(self.dir)
+
+    def write_cache(self, content):
+        os.makedirs(os.path.dirname(detect.DETECT_CACHE_FILE), exist_ok=True)
+        with open(detect.DETECT_CACHE_FILE, 'w') as f:
+            f.write(content)
+
+    def cache(self, **fields):
+        cache = {
+            'boot_id': BOOT_ID,
+            'sysmfr': 'ACME',
+            'sysname': 'Box 1',
+            'biosver': '1.0',
+            'module': 'vyatta.platform.type.acme',
+        }
+        cache.update(fields)
+        return cache
+
+    def test_round_trip(self):
+        detect.write_detect_cache(self.cache())
+        self.assertEqual(detect.read_detect_cache(BOOT_ID), self.cache())
+        detect.write_detect_cache(self.cache(module=None))
+        self.assertEqual(detect.read_detect_cache(BOOT_ID),
+                         self.cache(module=None))
+
+    def test_ignored_from_another_boot(self):
+        detect.write_detect_cache(self.cache())
+        self.assertIsNone(detect.read_detect_cache('another-boot'))
+        self.assertIsNone(detect.read_detect_cache(None))
+
+    def test_missing_or_unparseable(self):
+        self.assertIsNone(detect.read_detect_cache(BOOT_ID))
+        self.write_cache('{"boot_id": "' + BOOT_ID)
+        self.assertIsNone(detect.read_detect_cache(BOOT_ID))
+        self.write_cache('[]')
+        self.assertIsNone(detect.read_detect_cache(BOOT_ID))
+
+    def test_missing_or_mistyped_fields(self):
+        for field in ['sysmfr', 'sysname', 'biosver']:
+            cache = self.cache()
+            del cache[field]
+            self.write_cache(json.dumps(cache))
+            self.assertIsNone(detect.read_detect_cache(BOOT_ID))
+            self.write_cache(json.dumps(self.cache(**{field: 1})))
+            self.assertIsNone(detect.read_detect_cache(BOOT_ID))
+        self.write_cache(json.dumps(self.cache(module=['os'])))
+        self.assertIsNone(detect.read_detect_cache(BOOT_ID))
+
+    def test_write_failure_is_ignored(self):
+        # A directory can't be replaced by a file
+        os.makedirs(detect.DETECT_CACHE_FILE)
+        detect.write_detect_cache(self.cache())
+        self.assertEqual(os.listdir(os.path.dirname(detect.DETECT_CACHE_FILE)),
+                         ['platform-detect.json'])
+
+class TestManifestMatches(unittest.TestCase):
+    DMI = {
+        'sysmfr': 'ACME Corporation',
+        'sysname': 'Box 1000',
+        'biosver': 'ACME-1.0.3',
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.dir, 'acme.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_manifest(self, content):
+        with open(self.manifest, 'w') as f:
+            if isinstance(content, str):
+                f.write(content)
+            else:
+                json.dump(content, f)
+
+    def test_all_fields_of_an_entry_must_match(self):
+        self.write_manifest({'match': [
+            {'sysmfr': '^ACME', 'sysname': 'Box 1000$'},
+        ]})
+        self.assertTrue(detect.manifest_matches(self.manifest, self.DMI))
+        self.write_manifest({'match': [
+            {'sysmfr': '^ACME', 'sysname': 'Box 2000'},
+        ]})
+        self.assertFalse(detect.manifest_matches(self.manifest, self.DMI))
+
+    def test_any_entry_can_match(self):
+        self.write_manifest({'match': [
+            {'sysname': 'Box 2000'},
+            {'biosver': '^ACME-1\\.'},
+        ]})
+        self.assertTrue(detect.manifest_matches(self.manifest, self.DMI))
+        self.write_manifest({'match': []})
+        self.assertFalse(detect.manifest_matches(self.manifest, self.DMI))
+
+    def test_unusable_manifest_matches(self):
+        for content in ['{"match": ', '{}', '{"match": [{"sysmfr": "("}]}',
+                        '{"match": [{"chassis": "ACME"}]}',
+                        '{"match": [{"sysmfr": 1}]}']:
+            self.write_manifest(content)
+            self.assertTrue(detect.manifest_matches(self.manifest, self.DMI),
+                            content)
+        os.unlink(self.manifest)
+        self.assertTrue(detect.manifest_matches(self.manifest, self.DMI))
+
+if __name__ == '__main__':
+    unittest.main()
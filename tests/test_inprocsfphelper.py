@@ -0,0 +1,146 @@
+# Copyright (c) 2021, AT&T Intellectual Property.  All rights reserved.
+#
+# SPDX-License-Identifier: LGPL-2.1-only
+
+import json
+import unittest
+from vyatta.platform.inprocsfphelper import InprocSfpHelper
+from vyatta.platform.basesfphelper import SfpHelperException
+from vyatta.phy.basephy import BasePhy, PhyAccessException, PhyNotFoundException
+
+class FakeReqPool(object):
+    '''
+    Answers FAL requests from a list of canned replies, recording them
+    '''
+    def __init__(self, capabilities=None):
+        self.capabilities = capabilities
+        self.replies = []
+        self.requests = []
+
+    def request(self, req):
+        self.requests.append(req)
+        if req['command'] == 'CAPABILITIES':
+            if self.capabilities is None:
+                raise SfpHelperException("no reply from FAL")
+            return {'result': 'OK', 'capabilities': self.capabilities}
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def request_multipart(self, req):
+        reply = self.request(req)
+        if isinstance(reply, list):
+            return reply
+        return [json.dumps(reply).encode()]
+
+def make_helper(pool):
+    helper = InprocSfpHelper(None)
+    helper._req_pool = pool
+    return helper
+
+def subcmds(pool):
+    return [req.get('subcmd', req['command']) for req in pool.requests]
+
+OPS = [
+    (BasePhy.OP_READ, 0x56, 0x0100),
+    (BasePhy.OP_WRITE, 0x56, 0x0400, 0x1234),
+    (BasePhy.OP_MODIFY, 0x56, 0x0000, 0x0080, 0x0080),
+]
+
+class TestBatchWordData(unittest.TestCase):
+    def test_batch_when_advertised(self):
+        pool = FakeReqPool(['phy-batch'])
+        pool.replies = [{'result': 'OK', 'data': ['0x10', None, '0x80']}]
+        bus = make_helper(pool).get_bus('SFP', 1)
+        self.assertEqual(bus.batch_word_data(OPS), [0x10, None, 0x80])
+        self.assertEqual(subcmds(pool), ['CAPABILITIES', 'PHYBATCH'])
+        self.assertEqual(pool.requests[1]['ops'][2],
+                         {'op': BasePhy.OP_MODIFY, 'addr': 0x56,
+                          'regctrl': 0x0000, 'regmask': 0x0080,
+                          'regdata': 0x0080})
+
+    def test_singly_when_not_advertised(self):
+        pool = FakeReqPool([])
+        pool.replies = [{'result': 'OK', 'data': '0x10'},
+                        {'result': 'OK'},
+                        {'result': 'OK', 'data': '0x0'},
+                        {'result': 'OK'}]
+        bus = make_helper(pool).get_bus('SFP', 1)
+        self.assertEqual(bus.batch_word_data(OPS), [0x10, None, 0x80])
+        self.assertEqual(subcmds(pool),
+                         ['CAPABILITIES', 'PHYREADWORD', 'PHYWRITEWORD',
+                          'PHYREADWORD', 'PHYWRITEWORD'])
+
+    def test_capabilities_asked_again_after_timeout(self):
+        pool = FakeReqPool(None)
+        helper = make_helper(pool)
+        self.assertEqual(helper.get_fal_capabilities(), [])
+        pool.capabilities = ['phy-batch']
+        self.assertEqual(helper.get_fal_capabilities(), ['phy-batch'])
+        self.assertEqual(helper.get_fal_capabilities(), ['phy-batch'])
+        self.assertEqual(subcmds(pool), ['CAPABILITIES', 'CAPABILITIES'])
+
+    def test_error_keeps_batching(self):
+        pool = FakeReqPool(['phy-batch'])
+        pool.replies = [{'result': 'NOPHY'},
+                        {'result': 'OK', 'data': ['0x10', None, '0x80']}]
+        bus = make_helper(pool).get_bus('SFP', 1)
+        with self.assertRaises(PhyNotFoundException):
+            bus.batch_word_data(OPS)
+        self.assertEqual(bus.batch_word_data(OPS), [0x10, None, 0x80])
+        self.assertEqual(subcmds(pool),
+                         ['CAPABILITIES', 'PHYBATCH', 'PHYBATCH'])
+
+    def test_timeout_raises_access_error(self):
+        pool = FakeReqPool(['phy-batch'])
+        pool.replies = [SfpHelperException("no reply from FAL")]
+        bus = make_helper(pool).get_bus('SFP', 1)
+        with self.assertRaises(PhyAccessException):
+            bus.batch_word_data(OPS)
+
+    def test_reply_without_data_rejected(self):
+        pool = FakeReqPool(['phy-batch'])
+        pool.replies = [{'result': 'OK'}]
+        bus = make_helper(pool).get_bus('SFP', 1)
+        with self.assertRaises(PhyAccessException):
+            bus.batch_word_data(OPS)
+
+    def test_short_reply_rejected(self):
+        pool = FakeReqPool(['phy-batch'])
+        pool.replies = [{'result': 'OK', 'data': ['0x10', None]}]
+        bus = make_helper(pool).get_bus('SFP', 1)
+        with self.assertRaises(PhyAccessException):
+            bus.batch_word_data(OPS)
+
+class TestReadEeprom(unittest.TestCase):
+    def test_binary_when_advertised(self):
+        pool = FakeReqPool(['binary-eeprom'])
+        pool.replies = [[b'{"result": "OK", "length": 4}', b'\x01\x02\x03\x04']]
+        helper = make_helper(pool)
+        self.assertEqual(helper.read_eeprom('SFP', 1, 20, 4),
+                         b'\x01\x02\x03\x04')
+        self.assertEqual(pool.requests[1]['encoding'], 'binary')
+
+    def test_base64_when_not_advertised(self):
+        pool = FakeReqPool([])
+        pool.replies = [{'result': 'OK', 'data': 'AQIDBA=='}]
+        helper = make_helper(pool)
+        self.assertEqual(helper.read_eeprom('SFP', 1, 20, 4),
+                         b'\x01\x02\x03\x04')
+        self.assertNotIn('encoding', pool.requests[1])
+
+    def test_binary_reply_without_data_rejected(self):
+        pool = FakeReqPool(['binary-eeprom'])
+        pool.replies = [[b'{"result": "OK", "length": 4}']]
+        with self.assertRaises(SfpHelperException):
+            make_helper(pool).read_eeprom('SFP', 1, 20, 4)
+
+    def test_binary_reply_of_wrong_length_rejected(self):
+        pool = FakeReqPool(['binary-eeprom'])
+        pool.replies = [[b'{"result": "OK", "length": 4}', b'\x01\x02']]
+        with self.assertRaises(SfpHelperException):
+            make_helper(pool).read_eeprom('SFP', 1, 20, 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# Copyright (c) 2021, AT&T Intellectual Property.  All rights reserved.
+#
+# SPDX-License-Identifier: LGPL-2.1-only
+
+import importlib.machinery
+import importlib.util
+import os
+import queue
+import unittest
+
+SFPD_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'sbin', 'vyatta-sfpd')
+
+def load_sfpd():
+    loader = importlib.machinery.SourceFileLoader('vyatta_sfpd', SFPD_PATH)
+    spec = importlib.util.spec_from_loader('vyatta_sfpd', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+sfpd = load_sfpd()
+
+class FakeSfpDaemon(object):
+    '''
+    Stands in for both SfpDaemon and its SfpStateManager, recording
+    the presence changes processed
+    '''
+    def __init__(self):
+        self.sfpmgr = self
+        self.main_calls = queue.Queue()
+        self.processed = []
+
+    def run_on_main(self, func):
+        self.main_calls.put(func)
+
+    def run_main_call(self, timeout=2):
+        self.main_calls.get(timeout=timeout)()
+
+    def process_presence_change(self, portname, porttype, port, presence,
+                                extra_state):
+        self.processed.append((portname, presence))
+
+class TestPresenceDebouncer(unittest.TestCase):
+    def setUp(self):
+        self.daemon = FakeSfpDaemon()
+
+    def debouncer(self, debounce=0, hold_down=0, max_hold_down=60,
+                  flap_window=10):
+        return sfpd.PresenceDebouncer(self.daemon, debounce, hold_down,
+                                      max_hold_down, flap_window)
+
+    def test_immediate_changes_are_processed_straight_away(self):
+        debouncer = self.debouncer(debounce=60)
+        debouncer.report('xe1', 'SFP', 1, True, {}, immediate=True)
+        self.assertEqual(self.daemon.processed, [('xe1', True)])
+
+    def test_change_processed_once_settled(self):
+        debouncer = self.debouncer(debounce=0.01)
+        debouncer.report('xe1', 'SFP', 1, True, {})
+        self.assertEqual(self.daemon.processed, [])
+        self.daemon.run_main_call()
+        self.assertEqual(self.daemon.processed, [('xe1', True)])
+
+    def test_bounce_back_is_suppressed(self):
+        debouncer = self.debouncer(debounce=0.01)
+        debouncer.report('xe1', 'SFP', 1, False, {}, immediate=True)
+        debouncer.report('xe1', 'SFP', 1, True, {})
+        debouncer.report('xe1', 'SFP', 1, False, {})
+        self.daemon.run_main_call()
+        self.assertTrue(self.daemon.main_calls.empty())
+        self.assertEqual(self.daemon.processed, [('xe1', False)])
+        # Superseded, then back to how it was
+        self.assertEqual(debouncer.stats['suppressed'], 2)
+        self.assertEqual(debouncer.stats['ports']['xe1']['suppressed'], 2)
+
+    def test_removal_and_reinsertion_are_processed(self):
+        debouncer = self.debouncer(debounce=0.01)
+        debouncer.report('xe1', 'SFP', 1, True, {}, immediate=True)
+        debouncer.report('xe1', 'SFP', 1, False, {})
+        debouncer.report('xe1', 'SFP', 1, True, {})
+        self.daemon.run_main_call()
+        self.assertTrue(self.daemon.main_calls.empty())
+        # The module may have been replaced
+        self.assertEqual(self.daemon.processed, [('xe1', True),
+                                                 ('xe1', False),
+                                                 ('xe1', True)])
+        self.assertEqual(debouncer.stats['suppressed'], 0)
+
+    def test_removal_that_settles_is_processed_once(self):
+        debouncer = self.debouncer(debounce=0.01)
+        debouncer.report('xe1', 'SFP', 1, True, {}, immediate=True)
+        debouncer.report('xe1', 'SFP', 1, False, {})
+        debouncer.report('xe1', 'SFP', 1, True, {})
+        debouncer.report('xe1', 'SFP', 1, False, {})
+        self.daemon.run_main_call()
+        self.assertEqual(self.daemon.processed, [('xe1', True),
+                                                 ('xe1', False)])
+        self.assertEqual(debouncer.stats['suppressed'], 1)
+
+    def test_ports_are_debounced_independently(self):
+        debouncer = self.debouncer(debounce=0.01)
+        debouncer.report('xe1', 'SFP', 1, True, {})
+        debouncer.report('xe2', 'SFP', 2, True, {})
+        self.daemon.run_main_call()
+        self.daemon.run_main_call()
+        self.assertEqual(sorted(self.daemon.processed),
+                         [('xe1', True), ('xe2', True)])
+        self.assertEqual(debouncer.stats['suppressed'], 0)
+
+    def test_flapping_port_is_held_down(self):
+        debouncer = self.debouncer(hold_down=0.05, max_hold_down=0.1)
+        debouncer.report('xe1', 'SFP', 1, True, {})
+        debouncer.report('xe1', 'SFP', 1, False, {})
+        # The second change within the flap window damps the port
+        self.assertEqual(self.daemon.processed, [('xe1', True),
+                                                 ('xe1', False)])
+        self.assertEqual(debouncer.stats['damped'], 1)
+        debouncer.report('xe1', 'SFP', 1, True, {})
+        self.assertEqual(len(self.daemon.processed), 2)
+        self.daemon.run_main_call()
+        self.assertEqual(self.daemon.processed[-1], ('xe1', True))
+        self.assertEqual(debouncer.stats['damped'], 2)
+        self.assertEqual(debouncer.stats['ports']['xe1']['damped'], 2)
+
+    def test_hold_down_is_capped(self):
+        debouncer = self.debouncer(hold_down=0.01, max_hold_down=0.02)
+        presence = True
+        for _ in range(5):
+            debouncer.report('xe1', 'SFP', 1, presence, {})
+            if not self.daemon.main_calls.empty() or \
+               debouncer.ports[('SFP', 1)]['timer'] is not None:
+                self.daemon.run_main_call()
+            presence = not presence
+        state = debouncer.ports[('SFP', 1)]
+        self.assertEqual(len(self.daemon.processed), 5)
+        self.assertLessEqual(state['hold_until'] - state['last_commit'], 0.02)
+
+if __name__ == '__main__':
+    unittest.main()
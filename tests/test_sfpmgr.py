@@ -0,0 +1,730 @@
+# Copyright (c) 2021, AT&T Intellectual Property.  All rights reserved.
+#
+# SPDX-License-Identifier: LGPL-2.1-only
+
+import base64
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+import zmq
+from collections import deque
+from threading import Lock, RLock
+from vyatta.platform.sfpmgr import SfpEepromCache, SfpStateManager, SfpState
+from vyatta.platform.sfpmgr import PhyResetTracker, SfpModuleDescriptor
+from vyatta.phy.basephy import PhyAccessException
+
+class FakeSfpHelper(object):
+    '''
+    Serves EEPROM reads from an image per port, recording them
+    '''
+    MAX_CONCURRENT_READS = 1
+
+    def __init__(self):
+        self.images = {}
+        self.reads = []
+        self.short = False
+
+    def set_eeprom_cache(self, eeprom_cache):
+        pass
+
+    def invalidate_phy(self, porttype, port):
+        pass
+
+    def read_eeprom(self, porttype, port, offset=None, length=None):
+        self.reads.append((porttype, port, offset, length))
+        image = self.images[(porttype, port)]
+        if offset is None:
+            offset = 0
+        if not length:
+            return image[offset:]
+        if self.short:
+            length -= 1
+        return image[offset:offset + length]
+
+def eeprom_image(seed):
+    return bytes((seed + i) % 256 for i in range(512))
+
+class TestSfpEepromCache(unittest.TestCase):
+    def setUp(self):
+        self.helper = FakeSfpHelper()
+        self.helper.images[('SFP', 1)] = eeprom_image(1)
+        self.helper.images[('SFP', 2)] = eeprom_image(2)
+        self.helper.images[('QSFP', 1)] = eeprom_image(3)
+        self.cache = SfpEepromCache(self.helper)
+
+    def test_sfp_a0_page_read_once(self):
+        self.assertEqual(self.cache.read_eeprom('SFP', 1, 20, 16),
+                         eeprom_image(1)[20:36])
+        self.assertEqual(self.cache.read_eeprom('SFP', 1, 92, 1),
+                         eeprom_image(1)[92:93])
+        self.assertEqual(self.cache.read_eeprom('SFP', 1, 0, 256),
+                         eeprom_image(1)[:256])
+        self.assertEqual(self.helper.reads, [('SFP', 1, 0, 256)])
+
+    def test_qsfp_upper_page_00_read_once(self):
+        self.assertEqual(self.cache.read_eeprom('QSFP', 1, 148, 16),
+                         eeprom_image(3)[148:164])
+        self.assertEqual(self.cache.read_eeprom('QSFP', 1, 255, 1),
+                         eeprom_image(3)[255:256])
+        self.assertEqual(self.helper.reads, [('QSFP', 1, 128, 128)])
+
+    def test_other_ranges_always_read(self):
+        ranges = [
+            # SFP A2h diagnostics
+            ('SFP', 1, 256 + 96, 22),
+            # Straddling the end of A0h
+            ('SFP', 1, 250, 10),
+            # QSFP lower page
+            ('QSFP', 1, 3, 95),
+            # Straddling the start of QSFP upper page 00h
+            ('QSFP', 1, 120, 16),
+        ]
+        for _ in range(2):
+            for (porttype, port, offset, length) in ranges:
+                self.assertEqual(
+                    self.cache.read_eeprom(porttype, port, offset, length),
+                    self.helper.images[(porttype, port)][offset:offset + length])
+        self.assertEqual(self.helper.reads, ranges * 2)
+
+    def test_whole_eeprom_always_read(self):
+        self.cache.read_eeprom('SFP', 1, 0, 16)
+        self.assertEqual(self.cache.read_eeprom('SFP', 1), eeprom_image(1))
+        self.assertEqual(self.helper.reads, [('SFP', 1, 0, 256),
+                                             ('SFP', 1, None, None)])
+
+    def test_ports_cached_separately(self):
+        self.cache.read_eeprom('SFP', 1, 20, 16)
+        self.assertEqual(self.cache.read_eeprom('SFP', 2, 20, 16),
+                         eeprom_image(2)[20:36])
+        self.assertEqual(self.helper.reads, [('SFP', 1, 0, 256),
+                                             ('SFP', 2, 0, 256)])
+
+    def test_invalidate_drops_only_that_port(self):
+        self.cache.read_eeprom('SFP', 1, 20, 16)
+        self.cache.read_eeprom('SFP', 2, 20, 16)
+        self.cache.read_eeprom('QSFP', 1, 148, 16)
+        # A different module inserted in SFP port 1
+        self.helper.images[('SFP', 1)] = eeprom_image(9)
+        self.cache.invalidate('SFP', 1)
+        self.assertEqual(self.cache.read_eeprom('SFP', 1, 20, 16),
+                         eeprom_image(9)[20:36])
+        self.cache.read_eeprom('SFP', 2, 20, 16)
+        self.cache.read_eeprom('QSFP', 1, 148, 16)
+        self.assertEqual(self.helper.reads, [('SFP', 1, 0, 256),
+                                             ('SFP', 2, 0, 256),
+                                             ('QSFP', 1, 128, 128),
+                                             ('SFP', 1, 0, 256)])
+
+    def test_short_reads_not_cached(self):
+        self.helper.short = True
+        self.cache.read_eeprom('SFP', 1, 20, 16)
+        self.cache.read_eeprom('SFP', 1, 20, 16)
+        self.assertEqual(len(self.helper.reads), 2)
+
+class FakeSocket(object):
+    '''
+    Records what is sent on it
+    '''
+    def __init__(self):
+        self.sent = []
+
+    def send_json(self, msg):
+        self.sent.append(msg)
+
+    def send_string(self, msg):
+        self.sent.append(msg)
+
+    def send_multipart(self, frames):
+        self.sent.append(frames)
+
+def make_manager(sfpd_monitor=None):
+    '''
+    Build a state manager without any real sockets
+    '''
+    mgr = SfpStateManager.__new__(SfpStateManager)
+    mgr.rep_socket = FakeSocket()
+    mgr.monitor_socket = FakeSocket()
+    mgr.monitor_lock = Lock()
+    mgr.io_lock = RLock()
+    mgr.sfpd_monitor_callback = sfpd_monitor
+    mgr.monitor_delta = False
+    mgr.monitor_full_refresh = SfpStateManager.MONITOR_FULL_REFRESH_TICKS
+    mgr._monitor_ticks = 0
+    mgr._monitor_full_pending = True
+    mgr._monitor_published = {}
+    return mgr
+
+def monitor_data(eeprom):
+    return {'SFP': {'offset': 256 + 96, 'length': 10, 'eeprom': eeprom}}
+
+class TestMonitorDelta(unittest.TestCase):
+    def setUp(self):
+        self.data = monitor_data({'dp0xe1': b'a' * 10, 'dp0xe2': b'b' * 10})
+        self.mgr = make_manager(lambda: self.data)
+
+    def names(self, msg):
+        return sorted(sfp.name for sfp in msg.sfp)
+
+    def msg_types(self):
+        return [frames[0] for frames in self.mgr.monitor_socket.sent
+                if isinstance(frames, list)]
+
+    def test_changed_only_leaves_out_unchanged_ports(self):
+        self.assertEqual(self.names(self.mgr.build_monitor_msg(self.data)),
+                         ['dp0xe1', 'dp0xe2'])
+        self.data['SFP']['eeprom']['dp0xe2'] = b'c' * 10
+        msg = self.mgr.build_monitor_msg(self.data, changed_only=True)
+        self.assertEqual(self.names(msg), ['dp0xe2'])
+        msg = self.mgr.build_monitor_msg(self.data, changed_only=True)
+        self.assertEqual(self.names(msg), [])
+
+    def test_port_that_comes_back_is_published(self):
+        self.mgr.build_monitor_msg(self.data)
+        self.data['SFP']['eeprom']['dp0xe1'] = None
+        self.mgr.build_monitor_msg(self.data, changed_only=True)
+        self.data['SFP']['eeprom']['dp0xe1'] = b'a' * 10
+        msg = self.mgr.build_monitor_msg(self.data, changed_only=True)
+        self.assertEqual(self.names(msg), ['dp0xe1'])
+
+    def test_full_snapshots_without_delta_mode(self):
+        for _ in range(3):
+            self.mgr.run_sfp_monitor()
+        self.assertEqual(self.msg_types(), [b'SFPDSTATUS_MSG'] * 3)
+
+    def test_delta_mode_skips_unchanged_ticks(self):
+        self.mgr.monitor_delta = True
+        self.mgr.run_sfp_monitor()
+        self.mgr.run_sfp_monitor()
+        self.data['SFP']['eeprom']['dp0xe1'] = b'd' * 10
+        self.mgr.run_sfp_monitor()
+        self.assertEqual(self.msg_types(), [b'SFPDSTATUS_MSG',
+                                            b'SFPDSTATUS_DELTA_MSG'])
+
+    def test_full_refresh_period(self):
+        self.mgr.monitor_delta = True
+        self.mgr.monitor_full_refresh = 3
+        for tick in range(7):
+            self.data['SFP']['eeprom']['dp0xe1'] = bytes([tick]) * 10
+            self.mgr.run_sfp_monitor()
+        self.assertEqual(self.msg_types(), [b'SFPDSTATUS_MSG',
+                                            b'SFPDSTATUS_DELTA_MSG',
+                                            b'SFPDSTATUS_DELTA_MSG',
+                                            b'SFPDSTATUS_MSG',
+                                            b'SFPDSTATUS_DELTA_MSG',
+                                            b'SFPDSTATUS_DELTA_MSG',
+                                            b'SFPDSTATUS_MSG'])
+
+    def test_refresh_command_forces_snapshot(self):
+        self.mgr.monitor_delta = True
+        self.mgr.run_sfp_monitor()
+        self.mgr._process_sfpmonitorrefresh_command()
+        self.mgr.run_sfp_monitor()
+        self.assertEqual(self.msg_types(), [b'SFPDSTATUS_MSG',
+                                            b'SFPDSTATUS_MSG'])
+
+    def test_mode_command_rejects_bad_full_refresh(self):
+        reply = self.mgr._process_sfpmonitormode_command(
+            {'delta': True, 'full_refresh': 0})
+        self.assertEqual(self.mgr.monitor_full_refresh,
+                         SfpStateManager.MONITOR_FULL_REFRESH_TICKS)
+        self.assertNotEqual(reply['result'], 'OK')
+
+class SfpStateManagerTestCase(unittest.TestCase):
+    '''
+    Runs a state manager on ipc endpoints in a temporary directory
+    '''
+    HELPER = FakeSfpHelper
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rep_endpoint = 'ipc://' + os.path.join(self.tmpdir, 'rep')
+        self.helper = self.HELPER()
+        self.mgr = SfpStateManager(
+            'ipc://' + os.path.join(self.tmpdir, 'pub'), self.rep_endpoint,
+            'ipc://' + os.path.join(self.tmpdir, 'req'), self.helper,
+            FakeSocket())
+        self.ctx = zmq.Context.instance()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close(linger=0)
+        self.mgr._command_executor.shutdown()
+        self.mgr.rep_socket.close(linger=0)
+        self.mgr.pub_socket.close(linger=0)
+        os.close(self.mgr._main_calls_rfd)
+        os.close(self.mgr._main_calls_wfd)
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self, socket_type=zmq.REQ):
+        client = self.ctx.socket(socket_type)
+        client.connect(self.rep_endpoint)
+        self.clients.append(client)
+        return client
+
+    def pump_until(self, sockets, timeout=5.0):
+        '''
+        Run the manager's main loop work until each of the sockets
+        has something to receive
+        '''
+        deadline = time.monotonic() + timeout
+        while not all(sock.poll(0) for sock in sockets):
+            self.assertLess(time.monotonic(), deadline,
+                            "timed out waiting for replies")
+            self.mgr.process_rep_socket()
+            self.mgr.process_main_calls()
+            time.sleep(0.001)
+
+class TestRequestRouting(SfpStateManagerTestCase):
+    def test_replies_reach_their_clients(self):
+        worker_client = self.connect()
+        main_client = self.connect()
+        worker_client.send_json({'command': 'PHYLINKSTATUS'})
+        main_client.send_json({'command': 'SFPMONITORREFRESH'})
+        self.pump_until([worker_client, main_client])
+        self.assertEqual(worker_client.recv_json(), {'phy_links': {}})
+        self.assertEqual(main_client.recv_json(), {'result': 'OK'})
+
+    def test_many_requests_from_one_client(self):
+        client = self.connect(zmq.DEALER)
+        for i in range(5):
+            client.send_multipart([b'%d' % i, b'',
+                                   b'{"command": "PHYLINKSTATUS"}'])
+        replies = []
+        while len(replies) < 5:
+            self.pump_until([client])
+            replies.append(client.recv_multipart())
+        self.assertEqual(sorted(reply[0] for reply in replies),
+                         [b'%d' % i for i in range(5)])
+        for reply in replies:
+            self.assertEqual(reply[1], b'')
+            self.assertEqual(json.loads(reply[2]), {'phy_links': {}})
+
+    def test_bad_requests_get_replies(self):
+        client = self.connect()
+        client.send(b'not json')
+        self.pump_until([client])
+        self.assertEqual(client.recv_json(), {'result': 'bad command'})
+        client.send_json({'command': 'NOSUCHCOMMAND'})
+        self.pump_until([client])
+        self.assertEqual(client.recv_json()['result'],
+                         'unrecognised command NOSUCHCOMMAND')
+
+class TestCapabilities(SfpStateManagerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.helper.images[('SFP', 1)] = eeprom_image(1)
+        self.mgr.sfp_state['xe1'] = SfpState('SFP', 1, {})
+
+    def request(self, req):
+        client = self.connect()
+        client.send_json(req)
+        self.pump_until([client])
+        return client.recv_multipart()
+
+    def test_negotiation(self):
+        reply = json.loads(self.request({'command': 'CAPABILITIES',
+                                         'protocol': 3})[0])
+        self.assertEqual(reply['protocol'], 2)
+        self.assertIn('binary-eeprom', reply['capabilities'])
+        reply = json.loads(self.request({'command': 'CAPABILITIES'})[0])
+        self.assertEqual(reply, {'result': 'OK', 'protocol': 1,
+                                 'capabilities': []})
+
+    def test_binary_eeprom_read(self):
+        frames = self.request({'command': 'SFPREADEEPROM',
+                               'portname': 'xe1', 'offset': 20,
+                               'length': 16, 'encoding': 'binary'})
+        self.assertEqual(json.loads(frames[0]),
+                         {'result': 'OK', 'length': 16})
+        self.assertEqual(frames[1:], [eeprom_image(1)[20:36]])
+
+    def test_base64_eeprom_read(self):
+        frames = self.request({'command': 'SFPREADEEPROM',
+                               'portname': 'xe1', 'offset': 20,
+                               'length': 16})
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(base64.b64decode(json.loads(frames[0])['data']),
+                         eeprom_image(1)[20:36])
+
+class TestReplaySince(SfpStateManagerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = self.connect()
+
+    def publish(self, portname, port, presence):
+        self.mgr.on_sfp_presence_change(portname, 'SFP', port, presence,
+                                        {'has_diag': False})
+
+    def replay(self, **kwargs):
+        req = {'command': 'REPLAY'}
+        req.update(kwargs)
+        self.client.send_json(req)
+        self.pump_until([self.client])
+        return self.client.recv_json()
+
+    def test_events_after_since(self):
+        self.publish('xe1', 1, True)
+        self.publish('xe2', 2, True)
+        self.publish('xe1', 1, False)
+        reply = self.replay(since=1, epoch=self.mgr.epoch)
+        self.assertEqual(reply['full'], False)
+        self.assertEqual(reply['seq'], 3)
+        self.assertEqual([(event['seq'], list(event['ports']))
+                          for event in reply['events']],
+                         [(2, ['xe2']), (3, ['xe1'])])
+        self.assertEqual(reply['events'][1]['ports']['xe1']['present'],
+                         False)
+
+    def test_up_to_date_client(self):
+        self.publish('xe1', 1, True)
+        reply = self.replay(since=1, epoch=self.mgr.epoch)
+        self.assertEqual(reply, {'epoch': self.mgr.epoch, 'seq': 1,
+                                 'full': False, 'events': []})
+
+    def test_since_older_than_log(self):
+        self.mgr._event_log = deque(maxlen=2)
+        for port in range(1, 5):
+            self.publish('xe{}'.format(port), port, True)
+        reply = self.replay(since=2, epoch=self.mgr.epoch)
+        self.assertEqual([event['seq'] for event in reply['events']], [3, 4])
+        reply = self.replay(since=1, epoch=self.mgr.epoch)
+        self.assertEqual(reply['full'], True)
+        self.assertEqual(sorted(reply['ports']),
+                         ['xe1', 'xe2', 'xe3', 'xe4'])
+
+    def test_epoch_mismatch_gets_full_replay(self):
+        self.publish('xe1', 1, True)
+        self.publish('xe2', 2, True)
+        self.publish('xe2', 2, False)
+        reply = self.replay(since=1, epoch=self.mgr.epoch - 1)
+        self.assertEqual(reply['full'], True)
+        self.assertEqual(reply['epoch'], self.mgr.epoch)
+        self.assertEqual(reply['seq'], 3)
+        self.assertEqual(list(reply['ports']), ['xe1'])
+
+    def test_since_ahead_of_log_gets_full_replay(self):
+        self.publish('xe1', 1, True)
+        reply = self.replay(since=5, epoch=self.mgr.epoch)
+        self.assertEqual(reply['full'], True)
+
+    def test_replay_without_since(self):
+        self.publish('xe1', 1, True)
+        reply = self.replay()
+        self.assertEqual(list(reply), ['ports'])
+        self.assertEqual(reply['ports']['xe1']['present'], True)
+
+class TestReplayBytes(SfpStateManagerTestCase):
+    def publish(self, portname, port, presence):
+        self.mgr.on_sfp_presence_change(portname, 'SFP', port, presence,
+                                        {'has_diag': False})
+
+    def test_encoding_reused_until_state_changes(self):
+        self.assertEqual(json.loads(self.mgr._get_replay_bytes()), {})
+        self.publish('xe1', 1, True)
+        first = self.mgr._get_replay_bytes()
+        self.assertIs(self.mgr._get_replay_bytes(), first)
+        self.publish('xe2', 2, True)
+        second = self.mgr._get_replay_bytes()
+        self.assertIsNot(second, first)
+        self.assertEqual(sorted(json.loads(second)['ports']), ['xe1', 'xe2'])
+
+    def test_matches_full_serialisation(self):
+        self.publish('xe1', 1, True)
+        self.publish('xe2', 2, True)
+        self.publish('xe1', 1, False)
+        expected = {'ports': {}}
+        for portname, sfp_state in self.mgr.sfp_state.items():
+            expected['ports'].update(self.mgr._serialise_sfp_state(
+                portname, True, sfp_state)['ports'])
+        self.assertEqual(json.loads(self.mgr._get_replay_bytes()), expected)
+
+    def test_removing_last_port(self):
+        self.publish('xe1', 1, True)
+        self.publish('xe1', 1, False)
+        self.assertEqual(json.loads(self.mgr._get_replay_bytes()), {})
+
+class FakePhySfpHelper(FakeSfpHelper):
+    '''
+    Has a PHY whose resets complete after a number of polls, recording
+    when its driver is dropped
+    '''
+    def __init__(self):
+        super().__init__()
+        self.reset_polls = 1
+        self.reset_error = None
+        self.invalidated = []
+        self.link_status = ("down", 0, "unknown")
+        self.link_error = None
+        self.link_reads = 0
+        self._latched_status = None
+        self.sgmii_calls = []
+
+    def invalidate_phy(self, porttype, port):
+        self.invalidated.append((porttype, port))
+
+    def set_phy_speed_duplex(self, porttype, port, speed, duplex, wait=True):
+        return True
+
+    def set_sgmii_enabled(self, porttype, port, wait=True):
+        self.sgmii_calls.append((porttype, port, wait))
+        return True
+
+    def read_phy_link_status(self, porttype, port):
+        if self.link_error is not None:
+            raise self.link_error
+        self.link_reads += 1
+        self._latched_status = self.link_status
+        return self.link_status
+
+    def get_phy_link_change(self, porttype, port):
+        if self.link_error is not None:
+            raise self.link_error
+        if self.link_status == self._latched_status:
+            return None
+        return self.read_phy_link_status(porttype, port)
+
+    def get_phy_reset_complete(self, porttype, port):
+        if self.reset_error is not None:
+            raise self.reset_error
+        if self.reset_polls is None:
+            return False
+        self.reset_polls -= 1
+        return self.reset_polls <= 0
+
+@mock.patch.object(PhyResetTracker, 'POLL_INTERVAL', 0.001)
+@mock.patch.object(PhyResetTracker, 'RESET_TIMEOUT', 0.05)
+class TestPhyResetWait(SfpStateManagerTestCase):
+    HELPER = FakePhySfpHelper
+
+    def setUp(self):
+        super().setUp()
+        self.mgr.sfp_state['xe1'] = SfpState('SFP', 1, {})
+
+    def set_speed_duplex(self, **kwargs):
+        req = {'command': 'PHYSPEEDDUPLEXSET', 'portname': 'xe1',
+               'speed': 100, 'duplex': 'full'}
+        req.update(kwargs)
+        return self.mgr._run_command(req)
+
+    def test_sync_waits_for_reset(self):
+        self.helper.reset_polls = 3
+        self.assertEqual(self.set_speed_duplex(), {'result': 'OK'})
+        self.assertEqual(self.helper.reset_polls, 0)
+        self.assertEqual(self.helper.invalidated, [])
+
+    def test_sync_reset_timeout(self):
+        self.helper.reset_polls = None
+        self.assertEqual(self.set_speed_duplex(),
+                         {'result': 'reset timed out'})
+        self.assertEqual(self.helper.invalidated, [('SFP', 1)])
+
+    def test_sync_reset_access_error(self):
+        self.helper.reset_error = PhyAccessException("no reply")
+        self.assertEqual(self.set_speed_duplex(), {'result': 'no reply'})
+        self.assertEqual(self.helper.invalidated, [('SFP', 1)])
+
+    def test_async_reset_timeout(self):
+        self.helper.reset_polls = None
+        sub = self.ctx.socket(zmq.SUB)
+        self.clients.append(sub)
+        sub.connect('ipc://' + os.path.join(self.tmpdir, 'pub'))
+        sub.setsockopt_string(zmq.SUBSCRIBE, 'phyconfig')
+        # Let the subscription reach the publisher
+        time.sleep(0.1)
+        self.assertEqual(self.set_speed_duplex(**{'async': True}),
+                         {'result': 'OK', 'pending': True})
+        self.pump_until([sub])
+        topic, event = sub.recv_string().split(' ', 1)
+        self.assertEqual(json.loads(event)['ports']['xe1'],
+                         {'operation': 'PHYSPEEDDUPLEXSET',
+                          'result': 'reset timed out'})
+        self.assertEqual(self.helper.invalidated, [('SFP', 1)])
+
+class CountingLock(object):
+    '''
+    A reentrant lock that counts how deeply it is held
+    '''
+    def __init__(self):
+        self.lock = RLock()
+        self.depth = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.depth += 1
+
+    def __exit__(self, *args):
+        self.depth -= 1
+        self.lock.release()
+
+@mock.patch.object(PhyResetTracker, 'POLL_INTERVAL', 0.001)
+@mock.patch.object(PhyResetTracker, 'RESET_TIMEOUT', 0.05)
+class TestSgmiiBringUp(SfpStateManagerTestCase):
+    HELPER = FakePhySfpHelper
+
+    def setUp(self):
+        super().setUp()
+        self.mgr.io_lock = CountingLock()
+        self.sfp_state = SfpState('SFP', 1, {})
+        self.mgr.sfp_state['xe1'] = self.sfp_state
+        self.poll_depths = []
+        poll = self.helper.get_phy_reset_complete
+
+        def get_phy_reset_complete(porttype, port):
+            self.poll_depths.append(self.mgr.io_lock.depth)
+            return poll(porttype, port)
+        self.helper.get_phy_reset_complete = get_phy_reset_complete
+
+    def test_helper_released_during_reset(self):
+        self.helper.reset_polls = 3
+        self.mgr._enable_sgmii('xe1', self.sfp_state)
+        self.assertEqual(self.helper.sgmii_calls, [('SFP', 1, False)])
+        # Only held by each poll itself
+        self.assertEqual(self.poll_depths, [1, 1, 1])
+        self.mgr.process_main_calls()
+        self.assertTrue(self.sfp_state.state['sgmii_enabled'])
+
+    def test_reset_timeout_not_committed(self):
+        self.helper.reset_polls = None
+        self.mgr._enable_sgmii('xe1', self.sfp_state)
+        self.mgr.process_main_calls()
+        self.assertNotIn('sgmii_enabled', self.sfp_state.state)
+        self.assertEqual(self.helper.invalidated, [('SFP', 1)])
+
+    def test_replaced_module_skipped(self):
+        self.mgr.sfp_state['xe1'] = SfpState('SFP', 1, {})
+        self.mgr._enable_sgmii('xe1', self.sfp_state)
+        self.assertEqual(self.helper.sgmii_calls, [])
+
+class TestPhyLinkStatus(SfpStateManagerTestCase):
+    HELPER = FakePhySfpHelper
+
+    def setUp(self):
+        super().setUp()
+        self.mgr.sfp_state['xe1'] = SfpState('SFP', 1, {})
+        self.published = []
+        self.mgr.publish_phy_link_event = \
+            lambda portname, status: self.published.append((portname, status))
+
+    def update(self):
+        self.mgr.run_phy_link_monitor()
+        self.mgr.process_main_calls()
+
+    def test_changes_published(self):
+        self.update()
+        self.assertEqual(self.published, [])
+        self.helper.link_status = ("up", 1000, "full")
+        self.update()
+        self.update()
+        self.assertEqual(self.published, [('xe1', ("up", 1000, "full"))])
+        self.assertEqual(self.mgr.phy_link_state['xe1'], ("up", 1000, "full"))
+
+    def test_unchanged_status_not_read(self):
+        self.update()
+        self.update()
+        self.update()
+        self.assertEqual(self.helper.link_reads, 1)
+        self.assertEqual(self.mgr.phy_link_state['xe1'], ("down", 0, "unknown"))
+
+    def test_access_error_keeps_status(self):
+        self.helper.link_status = ("up", 1000, "full")
+        self.update()
+        self.helper.link_error = PhyAccessException("no reply")
+        self.update()
+        self.assertEqual(self.mgr.phy_link_state['xe1'], ("up", 1000, "full"))
+        self.helper.link_error = None
+        self.update()
+        self.assertEqual(self.published, [('xe1', ("up", 1000, "full"))])
+
+    def test_access_error_in_fresh_request(self):
+        self.helper.link_error = PhyAccessException("no reply")
+        reply = self.mgr._run_command({'command': 'PHYLINKSTATUS',
+                                       'fresh': True})
+        self.assertEqual(reply['phy_links']['xe1'],
+                         {'link': 'down', 'speed': 0, 'duplex': 'unknown'})
+        self.assertNotIn('xe1', self.mgr.phy_link_state)
+        self.assertEqual(self.published, [])
+
+def sfp_base_page(**fields):
+    '''
+    Build an SFP A0h base ID page, setting bytes given by offset
+    '''
+    data = bytearray(128)
+    data[20:36] = b'ACME CORP       '
+    data[37:40] = bytes([0x00, 0x90, 0x65])
+    data[40:56] = b'SFP-1G-T        '
+    data[56:60] = b'A1  '
+    for (offset, value) in fields.items():
+        data[int(offset[1:])] = value
+    return bytes(data)
+
+def qsfp_base_page(**fields):
+    '''
+    Build a QSFP upper page 00h, setting bytes given by their offset
+    in the flat address space
+    '''
+    data = bytearray(128)
+    data[148 - 128:164 - 128] = b'ACME CORP       '
+    data[165 - 128:168 - 128] = bytes([0x00, 0x17, 0x6a])
+    data[168 - 128:184 - 128] = b'QSFP-40G-SR4    '
+    data[184 - 128:186 - 128] = b'02'
+    for (offset, value) in fields.items():
+        data[int(offset[1:]) - 128] = value
+    return bytes(data)
+
+class TestSfpModuleDescriptor(unittest.TestCase):
+    def test_sfp(self):
+        descriptor = SfpModuleDescriptor('SFP', 1, sfp_base_page(
+            b3=0x10, b6=0x08, b36=0x1c, b94=0x08))
+        self.assertEqual(descriptor.extra_state, {
+            'eeprom_eth_10g': 0x10,
+            'eeprom_eth_compat': 0x08,
+            'eeprom_eth_extended_comp': 0x1c,
+            'has_diag': True,
+        })
+        self.assertEqual(descriptor.vendor_name, 'ACME CORP')
+        self.assertEqual(descriptor.vendor_oui, '009065')
+        self.assertEqual(descriptor.vendor_part_id, 'SFP-1G-T')
+        self.assertEqual(descriptor.vendor_rev, 'A1')
+
+    def test_sfp_without_diagnostics(self):
+        for compliance in [0x00, 0x0a, 0xff]:
+            descriptor = SfpModuleDescriptor('SFP', 1, sfp_base_page(
+                b94=compliance))
+            self.assertFalse(descriptor.extra_state['has_diag'])
+
+    def test_qsfp(self):
+        descriptor = SfpModuleDescriptor('QSFP', 2, qsfp_base_page(
+            b129=0x04, b131=0x80, b192=0x02, b147=0x00))
+        self.assertEqual(descriptor.extra_state, {
+            'rx_cdr_present': True,
+            'eeprom_eth_1040100g': 0x80,
+            'eeprom_eth_extended_comp': 0x02,
+            'has_diag': True,
+        })
+        self.assertEqual(descriptor.vendor_name, 'ACME CORP')
+        self.assertEqual(descriptor.vendor_oui, '00176a')
+        self.assertEqual(descriptor.vendor_part_id, 'QSFP-40G-SR4')
+        self.assertEqual(descriptor.vendor_rev, '02')
+
+    def test_copper_qsfp(self):
+        descriptor = SfpModuleDescriptor('QSFP', 2, qsfp_base_page(
+            b131=0x08, b192=0x02, b147=0x0a))
+        self.assertEqual(descriptor.extra_state, {
+            'rx_cdr_present': False,
+            'eeprom_eth_1040100g': 0x08,
+            'has_diag': False,
+        })
+
+    def test_undecodable_vendor_strings(self):
+        data = bytearray(sfp_base_page())
+        data[20:22] = b'\xff\xfe'
+        descriptor = SfpModuleDescriptor('SFP', 1, bytes(data))
+        self.assertEqual(descriptor.vendor_name, '\ufffd\ufffdME CORP')
+
+if __name__ == '__main__':
+    unittest.main()
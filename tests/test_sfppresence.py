@@ -0,0 +1,123 @@
+# Copyright (c) 2021, AT&T Intellectual Property.  All rights reserved.
+#
+# SPDX-License-Identifier: LGPL-2.1-only
+
+import os
+import shutil
+import tempfile
+import unittest
+from vyatta.platform import sfppresence
+from vyatta.platform.sfppresence import SfpPresenceTable
+from vyatta.platform.sfppresence import SfpPresenceTableReader
+from vyatta.platform.sfppresence import SfpPresenceTableError
+
+def presence_entry(porttype, port, **fields):
+    entry = {
+        'port': port,
+        'port_type': porttype,
+        'port_name': 'dp0xe{}'.format(port),
+        'vendor_name': 'ACME',
+        'vendor_oui': '00.90.65',
+        'vendor_part_id': 'SFP-1G-T',
+        'vendor_rev': 'A',
+        'time': '42',
+        'epoch': 1,
+        'has_diag': True,
+    }
+    entry.update(fields)
+    return entry
+
+class TestSfpPresenceTable(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sfpd-presence.tbl')
+        self.table = SfpPresenceTable(self.path)
+        self.reader = SfpPresenceTableReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.table.close()
+        shutil.rmtree(self.dir)
+
+    def test_update_lookup_and_clear(self):
+        self.assertTrue(self.table.created)
+        self.table.update(presence_entry('SFP', 3))
+        self.table.update(presence_entry('QSFP', 3, has_diag=False))
+        self.assertEqual(self.reader.lookup('SFP', 3),
+                         presence_entry('SFP', 3))
+        self.assertEqual(self.reader.lookup('QSFP', 3),
+                         presence_entry('QSFP', 3, has_diag=False))
+        self.table.clear('SFP', 3)
+        self.assertIsNone(self.reader.lookup('SFP', 3))
+        (entries, _) = self.reader.records()
+        self.assertEqual(entries, [presence_entry('QSFP', 3,
+                                                  has_diag=False)])
+
+    def test_generation_is_even_and_changes_with_each_update(self):
+        generation = self.reader.generation()
+        self.assertEqual(generation % 2, 0)
+        self.table.update(presence_entry('SFP', 1))
+        self.assertEqual(self.reader.generation(), generation + 2)
+        self.table.set_epoch(5, 100)
+        self.assertEqual(self.reader.generation(), generation + 4)
+        self.assertEqual(self.reader.get_epoch(), (5, 100))
+
+    def test_reader_gives_up_on_an_update_that_never_completes(self):
+        self.reader.UPDATE_TIMEOUT = 0.01
+        self.table._begin_update()
+        with self.assertRaises(SfpPresenceTableError):
+            self.reader.generation()
+        with self.assertRaises(SfpPresenceTableError):
+            self.reader.lookup('SFP', 1)
+
+    def test_reused_after_restart(self):
+        self.table.update(presence_entry('SFP', 1))
+        self.table.set_epoch(2, 30)
+        table = SfpPresenceTable(self.path)
+        self.assertFalse(table.created)
+        self.assertEqual(table.get_epoch(), (2, 30))
+        self.assertEqual(table.records(), [presence_entry('SFP', 1)])
+        table.close()
+
+    def test_recreated_in_place_after_interrupted_update(self):
+        self.table.update(presence_entry('SFP', 1))
+        generation = self.reader.generation()
+        self.table._begin_update()
+        table = SfpPresenceTable(self.path)
+        self.assertTrue(table.created)
+        # Seen by the reader, which still has the original mapping
+        self.assertGreater(self.reader.generation(), generation)
+        self.assertEqual(self.reader.records()[0], [])
+        table.update(presence_entry('SFP', 2))
+        self.assertEqual(self.reader.lookup('SFP', 2),
+                         presence_entry('SFP', 2))
+        table.close()
+
+    def test_long_strings_truncated_at_character_boundary(self):
+        self.table.update(presence_entry('SFP', 1,
+                                         vendor_name='Ä' * 9,
+                                         vendor_rev='1.2.3'))
+        entry = self.reader.lookup('SFP', 1)
+        self.assertEqual(entry['vendor_name'], 'Ä' * 8)
+        self.assertEqual(entry['vendor_rev'], '1.2.')
+
+    def test_port_slots(self):
+        self.assertEqual(sfppresence.port_slot('SFP', 5), 5)
+        self.assertEqual(sfppresence.port_slot('QSFP', 5), 133)
+        for (porttype, port) in [('SFP', 128), ('SFP', -1), ('XFP', 0)]:
+            with self.assertRaises(SfpPresenceTableError):
+                sfppresence.port_slot(porttype, port)
+
+    def test_reader_rejects_other_files(self):
+        other = os.path.join(self.dir, 'other')
+        with open(other, 'wb') as f:
+            f.write(b'\0' * sfppresence.TABLE_SIZE)
+        with self.assertRaises(SfpPresenceTableError):
+            SfpPresenceTableReader(other)
+        with open(other, 'wb') as f:
+            f.write(b'SFPP')
+        with self.assertRaises(SfpPresenceTableError):
+            SfpPresenceTableReader(other)
+
+if __name__ == '__main__':
+    unittest.main()